@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+""" Throughput benchmarks against the emulated VIA device """
+
+import argparse
+import json
+import logging
+import random
+import sys
+import time
+
+from kbprog import discover, keyboard
+from kbprog.keymapper import Keymapper
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='kbprog benchmarks')
+    parser.add_argument('--tag', default='u80a')
+    parser.add_argument('--layout')
+    parser.add_argument('--protocol', type=int, default=9)
+    parser.add_argument('--layers', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        metavar='MS', help='emulated reply latency')
+    parser.add_argument('--drop', type=float, default=0.0,
+                        metavar='RATE', help='emulated dropped reply rate')
+    parser.add_argument('--pipeline', type=int, default=1, metavar='N',
+                        help='requests kept in flight for bulk reads')
+    parser.add_argument('--report-size', type=int, default=32,
+                        help='emulated raw hid report size')
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--changes', type=int, default=64,
+                        help='keys changed per program run')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--bus-size', type=int, default=500,
+                        help='devices on the simulated bus for discovery')
+    parser.add_argument('benchmarks', nargs='*',
+                        default=['keyboard_map', 'program', 'discover'])
+    return parser
+
+
+def make_keyboard(args):
+    kbinfo = discover.emulate_discover(
+        args.tag, protocol=args.protocol, layers=args.layers,
+        latency=args.latency / 1000.0, drop_rate=args.drop,
+        seed=args.seed, report_size=args.report_size)[0]
+    return keyboard.Keyboard(pipeline=args.pipeline,
+                             **kbinfo)
+
+
+def timed(func, iterations):
+    times = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {'min': min(times),
+            'mean': sum(times) / len(times),
+            'max': max(times)}
+
+
+def bench_read(kb, args):
+    return timed(kb.keyboard_map, args.iterations)
+
+
+def bench_program(kb, args):
+    keymapper = Keymapper(kb, layout=args.layout)
+    keymapper.get_map()
+    rng = random.Random(args.seed)
+
+    def program():
+        for _ in range(args.changes):
+            layer = rng.randrange(kb.layers)
+            row = rng.randrange(kb.rows)
+            col = rng.randrange(kb.cols)
+            keymapper.dirtymap.set(keymapper.key_offset(layer, row, col),
+                                   rng.randrange(0x04, 0x64))
+        keymapper.program()
+
+    return timed(program, args.iterations)
+
+
+class SimulatedUsbDevice(object):
+    def __init__(self, vid, pid, version):
+        self.idVendor = vid
+        self.idProduct = pid
+        self.bcdDevice = version
+
+
+def simulated_bus(size, seed):
+    # mostly unrelated devices, with a handful of known boards mixed in
+    rng = random.Random(seed)
+    known = list(discover._index)
+
+    bus = []
+    for idx in range(size):
+        if idx % 50 == 0:
+            key = rng.choice(known)
+            version = key[2] if len(key) > 2 else rng.randrange(0x10000)
+            bus.append((key[0], key[1], version))
+        else:
+            bus.append((rng.randrange(0x10000), rng.randrange(0x10000),
+                        rng.randrange(0x10000)))
+    return bus
+
+
+def bench_discover(args):
+    bus = simulated_bus(args.bus_size, args.seed)
+    usb_bus = [SimulatedUsbDevice(*item) for item in bus]
+    hid_bus = [{'vendor_id': vid, 'product_id': pid,
+                'release_number': version,
+                'path': b'sim-%d' % idx}
+               for idx, (vid, pid, version) in enumerate(bus)]
+
+    def find(find_all=False, custom_match=None):
+        # what pyusb does with custom_match, minus the USB
+        return [d for d in usb_bus
+                if custom_match is None or custom_match(d)]
+
+    iterations = args.iterations * 20
+    return {
+        'usb': timed(lambda: discover.old_discover(find=find), iterations),
+        'hid': timed(lambda: discover.new_discover(
+            enumerate_hid=lambda: hid_bus), iterations),
+        'bus_size': args.bus_size,
+    }
+
+
+def main(rawargs):
+    args = get_parser().parse_args(rawargs)
+    logging.basicConfig(level=logging.WARNING)
+
+    results = {}
+    if 'discover' in args.benchmarks:
+        results['discover'] = bench_discover(args)
+
+    kb = make_keyboard(args)
+
+    for name, bench in [('keyboard_map', bench_read),
+                        ('program', bench_program)]:
+        if name not in args.benchmarks:
+            continue
+
+        before = sum(kb.device.commands.values())
+        results[name] = bench(kb, args)
+        results[name]['commands'] = (
+            sum(kb.device.commands.values()) - before) // args.iterations
+
+    print(json.dumps(results, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,77 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+
+def default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME',
+                          os.path.expanduser('~/.cache'))
+    return os.path.join(base, 'kbprog')
+
+
+class MapCache(object):
+    def __init__(self, path=None):
+        self.path = path or default_cache_dir()
+        self.logger = logging.getLogger(__name__)
+
+    def _file(self, identity):
+        digest = hashlib.sha1(identity.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, 'map-%s.json' % digest)
+
+    def load(self, identity):
+        cache_file = self._file(identity)
+        if not os.path.exists(cache_file):
+            return None
+
+        try:
+            with open(cache_file, 'r') as f:
+                snapshot = json.loads(f.read())
+        except Exception as e:
+            self.logger.warning('Ignoring bad cache file %s: %s',
+                                cache_file, str(e))
+            return None
+
+        if snapshot.get('identity') != identity:
+            return None
+
+        if 'protocol' not in snapshot:
+            return None
+
+        self.logger.debug('Loaded cached map for %s from %s',
+                          identity, cache_file)
+        return snapshot
+
+    def save(self, identity, kmap, protocol, layers, report_size):
+        # the board's protocol, layer count and report size go along,
+        # to check the map against and so the board needn't be asked
+        cache_file = self._file(identity)
+
+        snapshot = {'identity': identity,
+                    'time': time.time(),
+                    'protocol': protocol,
+                    'layers': layers,
+                    'report_size': report_size,
+                    'map': kmap}
+
+        # write then rename so a crash can't leave half a snapshot.
+        # The cache is only ever a shortcut, so failing to write it
+        # mustn't fail whatever was being done to the board.
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+            with open(tmp_file, 'w') as f:
+                f.write(json.dumps(snapshot))
+            os.replace(tmp_file, cache_file)
+        except OSError as e:
+            self.logger.debug('Could not save map to %s: %s',
+                              cache_file, str(e))
+            return
+
+        self.logger.debug('Saved map for %s to %s', identity, cache_file)
+
+    def invalidate(self, identity):
+        cache_file = self._file(identity)
+        if os.path.exists(cache_file):
+            os.unlink(cache_file)
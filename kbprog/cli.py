@@ -4,17 +4,69 @@ import argparse
 import json
 import logging
 import sys
-
-from kbprog import discover, keyboard, keys
-from kbprog.keymapper import Keymapper
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from kbprog import daemon, discover, hotplug, keyboard, keys, recording, \
+    snapshot
+from kbprog.cache import MapCache
+from kbprog.keymapper import Keymapper, load_target, snapshot_to_text, \
+    text_to_snapshot
 from kbprog.display import ProgramDisplay
 
 
+# keeps --all output from different devices from interleaving
+print_lock = threading.Lock()
+
+# boards opened by this run, for --stats and --record
+opened_lock = threading.Lock()
+opened = []
+
+LOG_FORMAT = '[%(asctime)s.%(msecs)03d] %(levelname)s [%(name)s:%(lineno)d] %(message)s'
+LOG_DATEFMT = '%Y-%m-%dT%H:%M:%S'
+
+
 def get_parser():
     parser = argparse.ArgumentParser(description='keyboard manager')
     parser.add_argument('--match', '-m')
     parser.add_argument('--debug', action='store_true')
     parser.add_argument('--hid', action='store_true')
+    parser.add_argument('--all', action='store_true',
+                        help='run the action on every matched device')
+    parser.add_argument('--jobs', '-j', type=int, default=8,
+                        help='devices handled at once with --all')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='don\'t use the on-disk keymap cache')
+    parser.add_argument('--pipeline', type=int, default=1, metavar='N',
+                        help='requests kept in flight for bulk reads')
+    parser.add_argument('--emulate', metavar='TAG',
+                        help='use an emulated board instead of hardware')
+    parser.add_argument('--emulate-latency', type=float, default=0.0,
+                        metavar='MS', help='emulated reply latency')
+    parser.add_argument('--emulate-drop', type=float, default=0.0,
+                        metavar='RATE', help='emulated dropped reply rate')
+    parser.add_argument('--emulate-protocol', type=int, default=9)
+    parser.add_argument('--emulate-layers', type=int, default=4)
+    parser.add_argument('--emulate-count', type=int, default=1)
+    parser.add_argument('--emulate-report-size', type=int, default=32)
+    parser.add_argument('--stats', action='store_true',
+                        help='report per-command counts and latencies')
+    parser.add_argument('--stats-file', metavar='FILE',
+                        help='write the --stats report here, not stdout')
+    parser.add_argument('--record', metavar='FILE',
+                        help='record the report stream to FILE; with '
+                        '--all or provision, may use {tag}, {name}, {id}, '
+                        '{index} and {path}')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='use a recorded session instead of hardware')
+    parser.add_argument('--replay-timing', choices=('fast', 'original'),
+                        default='fast',
+                        help='replay as fast as possible, or with the '
+                        'recorded device delays')
+    parser.add_argument('--socket', help='daemon socket path')
+    parser.add_argument('--no-daemon', action='store_true',
+                        help='don\'t hand the action to a running daemon')
 
     subparsers = parser.add_subparsers(help='action', dest='action')
 
@@ -22,6 +74,15 @@ def get_parser():
     subparsers.add_parser('list', help='list devices')
     subparsers.add_parser('bootloader', help='bootloader')
     subparsers.add_parser('map', help='map')
+    subparsers.add_parser('serve', help='keep boards open and serve '
+                          'other kbprog runs over a unix socket')
+
+    watch_parser = subparsers.add_parser(
+        'watch', help='report boards as they are plugged in and removed')
+    watch_parser.add_argument('--interval', type=float, default=1.0,
+                              help='seconds between rescans when polling')
+    watch_parser.add_argument('--poll', action='store_true',
+                              help='poll even if udev is available')
 
     edit_parser = subparsers.add_parser('edit', help='edit')
     edit_parser.add_argument('--layout', help='key layout format')
@@ -36,70 +97,170 @@ def get_parser():
                                 help='what effect (next/prev/number)')
 
     macro_parser = subparsers.add_parser('macro', help='set macros')
-    macro_parser.add_argument('index', type=int)
-    macro_parser.add_argument('value')
+    macro_parser.add_argument('pairs', nargs='*', metavar='INDEX VALUE',
+                              help='macro numbers and their new values')
+    macro_parser.add_argument('--file',
+                              help='file of "INDEX VALUE" lines')
 
     backup_parser = subparsers.add_parser('backup', help='backup key map')
-    backup_parser.add_argument('file')
+    backup_parser.add_argument(
+        'file', help='output file; with --all, may use {tag}, {name}, '
+        '{id}, {index} and {path}')
     backup_parser.add_argument('--layout', help='key layout format')
+    backup_parser.add_argument('--macros', action='store_true',
+                               help='include the macro buffer')
 
 
     restore_parser = subparsers.add_parser('restore', help='restore key map')
-    restore_parser.add_argument('file')
+    restore_parser.add_argument(
+        'file', help='input file; with --all, may use {tag}, {name}, '
+        '{id}, {index} and {path}')
     restore_parser.add_argument('--layout', help='key layout format')
     restore_parser.add_argument('--dry-run', action='store_true')
+    restore_parser.add_argument('--verify', action='store_true',
+                                help='read back the written keys')
+
+    convert_parser = subparsers.add_parser(
+        'convert', help='convert between text backups and %s snapshots' %
+        snapshot.SUFFIX)
+    convert_parser.add_argument('input')
+    convert_parser.add_argument('output')
+    convert_parser.add_argument('--tag',
+                                help='board a text backup is for')
+
+    provision_parser = subparsers.add_parser(
+        'provision', help='restore one key map onto every matched board')
+    provision_parser.add_argument('file')
+    provision_parser.add_argument('--layout', help='key layout format')
+    provision_parser.add_argument('--no-read', action='store_true',
+                                  help='write every key without reading '
+                                  'the current map first')
+    provision_parser.add_argument('--verify', action='store_true',
+                                  help='read back the written keys')
+    provision_parser.add_argument('--report',
+                                  help='write a JSON report to this file')
 
     # save_parser = led_subparsers.add_parser('save', help='save')
 
     return parser
 
 
-def do_edit(kb, layout):
-    keymapper = Keymapper(kb, layout=layout)
+def do_edit(kb, layout, cache=None):
+    keymapper = Keymapper(kb, layout=layout, cache=cache)
     programmer = ProgramDisplay(keymapper)
 
     programmer.run()
 
 
-def main(rawargs):
-    args = get_parser().parse_args(rawargs)
+def open_keyboard(kbinfo, args, pool=None, index=0, cache=None):
+    # restore --dry-run leaves the board closed when the map cache
+    # already has everything it needs
+    entry = None
+    if cache is not None and args.action == 'restore' and args.dry_run \
+            and not args.record and not args.replay:
+        entry = cache.load(keyboard.board_identity(kbinfo))
 
-    fmt = '[%(asctime)s.%(msecs)03d] %(levelname)s [%(name)s:%(lineno)d] %(message)s'
-    level = logging.DEBUG if args.debug else logging.INFO
+    if entry is not None:
+        kb = keyboard.Keyboard(pipeline=args.pipeline, offline=entry,
+                               **kbinfo)
+    # a replay can only be played through once, so never pool it
+    elif pool is not None and not args.replay:
+        kb = pool.get(kbinfo, pipeline=args.pipeline)
+    else:
+        kb = keyboard.Keyboard(pipeline=args.pipeline, **kbinfo)
 
-    logging.basicConfig(format=fmt, level=level, datefmt='%Y-%m-%dT%H:%M:%S')
+    # pooled boards carry stats over from earlier requests
+    kb.stats.clear()
 
-    results = discover.discover(match=args.match, use_hid=args.hid)
+    if args.record:
+        header = recording.kbinfo_header(kbinfo, kb.transport)
+        kb.transport = recording.RecordingTransport(
+            kb.transport, device_file(args.record, kb, index, args), header)
+        # probe again through the recorder, so replays are complete
+        kb.invalidate()
 
-    if len(results) == 0:
-        logging.error('no results')
-        return 0
+    with opened_lock:
+        opened.append(kb)
 
-    if args.action == 'list':
-        for item in results:
-            logging.info('%s %s (%s)', item['id'], item['name'], item['tag'])
-        return 0
+    return kb
 
-    if len(results) > 1:
-        logging.error('multiple results: %s',
-                      ', '.join(x['tag'] for x in results))
-        return 1
 
-    kbinfo = results[0]
+def finish_recordings():
+    with opened_lock:
+        for kb in opened:
+            if isinstance(kb.transport, recording.RecordingTransport):
+                kb.transport = kb.transport.finish()
 
-    # kb = keyboard.Keyboard(kbinfo['device'],
-    #                        kbinfo['tag'],
-    #                        kbinfo['name'],
-    #                        kbinfo['rows'],
-    #                        kbinfo['cols'])
-    kb = keyboard.Keyboard(**{k: v for k, v in kbinfo.items() if k != 'id'})
 
+def write_stats(args):
+    report = {}
+    with opened_lock:
+        for kb in opened:
+            label = '%s (%s)' % (kb.tag, kb.device_path)
+            report[label] = {'totals': kb.stats.totals(),
+                             'commands': kb.stats.report(),
+                             'rtt': kb.timing()}
+
+    output = json.dumps(report, indent=2)
+    if args.stats_file:
+        with open(args.stats_file, 'w') as f:
+            f.write(output)
+    else:
+        with print_lock:
+            print(output)
+
+
+def close_keyboard(kb, pool=None):
+    # after a failure or a bootloader jump the handle is no good
+    if pool is not None:
+        pool.discard(kb)
+
+
+def device_file(template, kb, index, args):
+    # per-device file names for --all (and provision, which always
+    # runs on every matched board), e.g. "backup-{tag}-{path}.txt".
+    # Otherwise the name is taken as it is, braces and all.
+    if not args.all and args.action != 'provision':
+        return template
+
+    path = str(kb.device_path)
+    for char in '/:. ':
+        path = path.replace(char, '_')
+
+    return template.format(tag=kb.tag, name=kb.name, id=kb.device_id,
+                           index=index, path=path.strip('_'))
+
+
+def macro_pairs(args):
+    if len(args.pairs) % 2:
+        raise RuntimeError('macro values come in INDEX VALUE pairs')
+
+    pairs = [(int(args.pairs[idx]), args.pairs[idx + 1])
+             for idx in range(0, len(args.pairs), 2)]
+
+    if args.file:
+        with open(args.file, 'r') as f:
+            for line in f:
+                line = line.rstrip('\n')
+                if not line.strip() or line.startswith('#'):
+                    continue
+                index, _, value = line.partition(' ')
+                pairs.append((int(index), value))
+
+    if not pairs:
+        raise RuntimeError('no macros given')
+
+    return pairs
+
+
+def run_action(kb, args, cache=None, index=0):
     if args.action == 'edit':
-        do_edit(kb, args.layout)
+        do_edit(kb, args.layout, cache=cache)
     elif args.action == 'info':
         print(kb.dump())
     elif args.action == 'macro':
-        kb.set_macro(args.index, args.value)
+        for macro_index, macro_value in macro_pairs(args):
+            kb.set_macro(macro_index, macro_value)
         kb.save_macros()
     elif args.action == 'bootloader':
         kb.bootloader()
@@ -109,27 +270,39 @@ def main(rawargs):
         for layer in range(kb.layers):
             logging.info('Layer %d', layer)
             for row in range(kb.rows):
-                rowdata = kmap[layer][row]
+                rowdata = kmap[layer][row].tolist()
                 logging.info(rowdata)
 
                 pretty = ', '.join(map(keys.label_for_keycode, rowdata))
                 logging.info('%s', pretty)
 
-        print(json.dumps(kmap, indent=2))
+        with print_lock:
+            print(json.dumps(kmap.tolist(), indent=2))
     elif args.action == 'backup':
-        keymapper = Keymapper(kb, layout=args.layout)
+        keymapper = Keymapper(kb, layout=args.layout, cache=cache)
         logging.info('getting keyboard map')
 
         keymapper.get_map()
-        keymapper.backup(args.file)
+        keymapper.backup(device_file(args.file, kb, index, args),
+                         macros=args.macros)
 
     elif args.action == 'restore':
-        keymapper = Keymapper(kb, layout=args.layout)
-        logging.info('loading existing map')
-        keymapper.get_map()
-        keymapper.restore(args.file)
-        if not args.dry_run:
-            keymapper.program()
+        keymapper = Keymapper(kb, layout=args.layout, cache=cache)
+        if args.dry_run and keymapper.load_cached_map():
+            logging.info('using cached map')
+        else:
+            logging.info('loading existing map')
+            keymapper.get_map()
+        keymapper.restore(device_file(args.file, kb, index, args))
+        if args.dry_run:
+            plan = keymapper.plan()
+            with print_lock:
+                print('plan %s' % plan.describe())
+                for alternative in plan.alternatives:
+                    print('  vs %s' % alternative.describe())
+        else:
+            keymapper.program(verify=args.verify)
+            keymapper.program_macros()
 
     elif args.action == 'led':
         if args.subaction == 'effect':
@@ -150,6 +323,297 @@ def main(rawargs):
         elif args.subaction == 'save':
             kb.save()
 
+    return 0
+
+
+def run_device(kbinfo, args, cache=None, index=0, pool=None):
+    start = time.monotonic()
+    label = '%s #%d' % (kbinfo['tag'], index)
+    kb = None
+
+    try:
+        kb = open_keyboard(kbinfo, args, pool=pool, index=index,
+                           cache=cache)
+        label = '%s (%s)' % (kb.tag, kb.device_path)
+        retval = run_action(kb, args, cache=cache, index=index)
+    except Exception as e:
+        logging.exception('%s: failed', label)
+        if kb is not None:
+            close_keyboard(kb, pool=pool)
+        return label, 1, time.monotonic() - start, str(e)
+
+    if args.action == 'bootloader':
+        close_keyboard(kb, pool=pool)
+
+    return label, retval, time.monotonic() - start, None
+
+
+def run_all(results, args, cache=None, pool=None):
+    if args.action in ('edit',):
+        logging.error('%s can\'t be run with --all', args.action)
+        return 1
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [executor.submit(run_device, kbinfo, args, cache=cache,
+                                   index=index, pool=pool)
+                   for index, kbinfo in enumerate(results)]
+        statuses = [future.result() for future in futures]
+
+    failed = 0
+    for label, retval, elapsed, error in statuses:
+        if retval == 0:
+            logging.info('%s: ok (%.2fs)', label, elapsed)
+        else:
+            failed += 1
+            logging.error('%s: failed (%.2fs): %s', label, elapsed, error)
+
+    logging.info('%d of %d devices succeeded',
+                 len(statuses) - failed, len(statuses))
+
+    return 1 if failed else 0
+
+
+def provision_device(kbinfo, args, layout, layers, target, index=0,
+                     pool=None):
+    start = time.monotonic()
+    report = {'device': '%s #%d' % (kbinfo['tag'], index),
+              'status': 'ok',
+              'keys_changed': 0,
+              'writes': 0}
+    kb = None
+
+    try:
+        kb = open_keyboard(kbinfo, args, pool=pool, index=index)
+        report['device'] = '%s (%s)' % (kb.tag, kb.device_path)
+
+        keymapper = Keymapper(kb, layout=layout)
+        if keymapper.layers != layers:
+            raise RuntimeError('Board has %d layers, file has %d' % (
+                keymapper.layers, layers))
+
+        if args.no_read:
+            keymapper.assume_map()
+            keymapper.apply_target(target, force=True)
+        else:
+            keymapper.get_map()
+            keymapper.apply_target(target)
+
+        report['keys_changed'], report['writes'] = keymapper.program(
+            force=args.no_read, verify=args.verify)
+        report['verified'] = args.verify
+    except Exception as e:
+        logging.exception('%s: failed', report['device'])
+        if kb is not None:
+            close_keyboard(kb, pool=pool)
+        report['status'] = 'failed'
+        report['error'] = str(e)
+
+    report['seconds'] = time.monotonic() - start
+    return report
+
+
+def do_provision(results, args, pool=None):
+    start = time.monotonic()
+
+    # parse the file once per kind of board, not once per board
+    targets = {}
+    for kbinfo in results:
+        if kbinfo['tag'] not in targets:
+            targets[kbinfo['tag']] = load_target(args.file, kbinfo['tag'],
+                                                 args.layout)
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [executor.submit(provision_device, kbinfo, args,
+                                   *targets[kbinfo['tag']], index=index,
+                                   pool=pool)
+                   for index, kbinfo in enumerate(results)]
+        reports = [future.result() for future in futures]
+
+    elapsed = time.monotonic() - start
+    failed = 0
+
+    for report in reports:
+        if report['status'] == 'ok':
+            logging.info('%s: %d keys changed in %d writes (%.2fs)',
+                         report['device'], report['keys_changed'],
+                         report['writes'], report['seconds'])
+        else:
+            failed += 1
+            logging.error('%s: failed (%.2fs): %s', report['device'],
+                          report['seconds'], report['error'])
+
+    logging.info('%d of %d boards provisioned in %.2fs',
+                 len(reports) - failed, len(reports), elapsed)
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            f.write(json.dumps({'file': args.file,
+                                'seconds': elapsed,
+                                'devices': reports}, indent=2))
+
+    return 1 if failed else 0
+
+
+def do_convert(args):
+    if snapshot.is_snapshot(args.input):
+        snapshot_to_text(args.input, args.output)
+        return 0
+
+    if not args.tag:
+        raise RuntimeError('converting a text backup needs --tag')
+
+    for device_info in discover.devices.values():
+        if device_info['tag'] == args.tag:
+            break
+    else:
+        raise RuntimeError('No known device with tag %s' % args.tag)
+
+    text_to_snapshot(args.input, args.output, args.tag,
+                     device_info['rows'], device_info['cols'])
+    return 0
+
+
+def do_watch(args):
+    events = hotplug.watch(match=args.match, use_hid=args.hid,
+                           interval=args.interval, use_udev=not args.poll)
+    try:
+        for event, info in events:
+            logging.info('%s %s %s (%s)', event, info['id'],
+                         info['name'], info['tag'])
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+def run(rawargs, pool=None):
+    # entry point for the daemon, which has its own logging set up
+    args = get_parser().parse_args(rawargs)
+    if args.action in daemon.LOCAL_ACTIONS:
+        logging.error('%s can\'t be run through the daemon', args.action)
+        return 1
+    return dispatch(args, pool=pool)
+
+
+def dispatch(args, pool=None):
+    with opened_lock:
+        del opened[:]
+
+    try:
+        return _dispatch(args, pool=pool)
+    finally:
+        finish_recordings()
+        if args.stats or args.stats_file:
+            write_stats(args)
+        with opened_lock:
+            del opened[:]
+
+
+def _dispatch(args, pool=None):
+    emulate_args = {}
+    if args.emulate:
+        emulate_args = {'latency': args.emulate_latency / 1000.0,
+                        'drop_rate': args.emulate_drop,
+                        'protocol': args.emulate_protocol,
+                        'layers': args.emulate_layers,
+                        'count': args.emulate_count,
+                        'report_size': args.emulate_report_size}
+
+    if args.action == 'watch':
+        return do_watch(args)
+    if args.action == 'convert':
+        return do_convert(args)
+
+    if args.replay:
+        results = discover.replay_discover(
+            args.replay, realtime=args.replay_timing == 'original')
+    else:
+        results = discover.discover(match=args.match, use_hid=args.hid,
+                                    emulate=args.emulate, **emulate_args)
+
+        if pool is not None and args.match is None and not args.emulate:
+            pool.prune(results, args.hid)
+
+    if len(results) == 0:
+        logging.error('no results')
+        return 0
+
+    if args.action == 'list':
+        for item in results:
+            logging.info('%s %s (%s)', item['id'], item['name'], item['tag'])
+        return 0
+
+    if args.action == 'provision':
+        return do_provision(results, args, pool=pool)
+
+    cache = None if args.no_cache else MapCache()
+
+    if args.all:
+        return run_all(results, args, cache=cache, pool=pool)
+
+    if len(results) > 1:
+        logging.error('multiple results (use --all): %s',
+                      ', '.join(x['tag'] for x in results))
+        return 1
+
+    kbinfo = results[0]
+
+    # kb = keyboard.Keyboard(kbinfo['device'],
+    #                        kbinfo['tag'],
+    #                        kbinfo['name'],
+    #                        kbinfo['rows'],
+    #                        kbinfo['cols'])
+    kb = open_keyboard(kbinfo, args, pool=pool, cache=cache)
+
+    try:
+        retval = run_action(kb, args, cache=cache)
+    except Exception:
+        close_keyboard(kb, pool=pool)
+        raise
+
+    if args.action == 'bootloader':
+        close_keyboard(kb, pool=pool)
+
+    return retval
+
+
+def run_daemon_client(rawargs, args):
+    # None if no daemon is listening, so the caller runs locally
+    try:
+        response = daemon.call(rawargs, path=args.socket, debug=args.debug)
+    except Exception as e:
+        logging.error('daemon request failed: %s', str(e))
+        return 1
+
+    if response is None:
+        return None
+
+    for line in response['log']:
+        sys.stderr.write(line + '\n')
+    sys.stdout.write(response['stdout'])
+    sys.stdout.flush()
+
+    return response['status']
+
+
+def main(rawargs):
+    args = get_parser().parse_args(rawargs)
+
+    level = logging.DEBUG if args.debug else logging.INFO
+
+    logging.basicConfig(format=LOG_FORMAT, level=level, datefmt=LOG_DATEFMT)
+
+    if args.action == 'serve':
+        return daemon.serve(args.socket or daemon.socket_path(), run,
+                            LOG_FORMAT, LOG_DATEFMT)
+
+    if not args.no_daemon and args.action not in daemon.LOCAL_ACTIONS:
+        retval = run_daemon_client(rawargs, args)
+        if retval is not None:
+            return retval
+
+    return dispatch(args)
+
 
 if __name__ == '__main__':
-    main(sys.argv[1:])
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,319 @@
+import contextlib
+import io
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import stat
+import threading
+from concurrent.futures import Future
+
+from kbprog import hotplug, keyboard
+
+
+logger = logging.getLogger(__name__)
+
+# actions that need the caller's terminal/display, never finish, or
+# don't touch a board at all
+LOCAL_ACTIONS = ('edit', 'watch', 'serve', 'convert')
+
+
+def socket_path():
+    # XDG_RUNTIME_DIR is already private to the user; /tmp isn't, so
+    # the socket goes in a directory of our own there (see _private_dir)
+    base = os.environ.get('XDG_RUNTIME_DIR')
+    if base:
+        return os.path.join(base, 'kbprog.sock')
+    return os.path.join('/tmp/kbprog-%d' % os.getuid(), 'kbprog.sock')
+
+
+def _owned(st):
+    return st.st_uid == os.getuid()
+
+
+def _private_dir(path):
+    # the directory a socket is about to be bound in: created 0700 if
+    # it's missing, refused if someone else got there first
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or not _owned(st) or \
+            stat.S_IMODE(st.st_mode) & 0o077:
+        raise RuntimeError('%s is not a private directory of ours' % path)
+
+
+def _is_our_socket(path):
+    # anyone can create a socket at a known path, and whoever answers
+    # on it sees every command line and decides what it printed
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(st.st_mode) and _owned(st)
+
+
+class KeyboardPool(object):
+    # open, already probed Keyboards, kept by hotplug.device_key() so
+    # later requests skip find_hidpath and get_protocol.  What's stored
+    # on the board is read afresh for each request, and USB interfaces
+    # are released after each one (see release()), so local runs like
+    # edit or --no-daemon can still claim a pooled board in between.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.keyboards = {}
+        self.infos = {}
+        # key -> Future, for boards some thread is opening right now
+        self.opening = {}
+
+    def get(self, kbinfo, pipeline=1):
+        # boards are opened and probed outside the lock, so an --all
+        # run opens them in parallel; a second request for a board
+        # that's still being opened waits for the first
+        key = hotplug.device_key(kbinfo)
+        with self.lock:
+            kb = self.keyboards.get(key)
+            opening = None
+            if kb is None:
+                opening = self.opening.get(key)
+                if opening is None:
+                    self.opening[key] = Future()
+            else:
+                kb.forget_contents()
+
+        if opening is not None:
+            kb = opening.result()
+        elif kb is None:
+            kb = self._open(key, kbinfo, pipeline)
+
+        kb.pipeline = pipeline
+        return kb
+
+    def _open(self, key, kbinfo, pipeline):
+        logger.info('Opening %s %s', kbinfo['tag'], key)
+        try:
+            kb = keyboard.Keyboard(pipeline=pipeline, **kbinfo)
+        except Exception as e:
+            with self.lock:
+                self.opening.pop(key).set_exception(e)
+            raise
+
+        with self.lock:
+            self.keyboards[key] = kb
+            self.infos[key] = kbinfo
+            self.opening.pop(key).set_result(kb)
+        return kb
+
+    def release(self):
+        # between requests
+        with self.lock:
+            keyboards = list(self.keyboards.items())
+        for key, kb in keyboards:
+            try:
+                kb.transport.release()
+            except Exception as e:
+                logger.debug('Error releasing %s: %s', key, str(e))
+
+    def discard(self, kb):
+        with self.lock:
+            for key, pooled in list(self.keyboards.items()):
+                if pooled is kb:
+                    self._close(key)
+
+    def prune(self, results, use_hid):
+        # drop boards that were unplugged, given a full (unmatched)
+        # discovery of one kind of device
+        current = set(hotplug.device_key(info) for info in results)
+        with self.lock:
+            for key, info in list(self.infos.items()):
+                if info['use_hid'] == use_hid and \
+                        not info.get('emulated') and key not in current:
+                    self._close(key)
+
+    def close(self):
+        with self.lock:
+            for key in list(self.keyboards):
+                self._close(key)
+
+    def _close(self, key):
+        logger.info('Closing %s', key)
+        kb = self.keyboards.pop(key)
+        self.infos.pop(key)
+        try:
+            kb.transport.close()
+        except Exception as e:
+            logger.debug('Error closing %s: %s', key, str(e))
+
+    def __len__(self):
+        with self.lock:
+            return len(self.keyboards)
+
+
+class _CaptureHandler(logging.Handler):
+    def __init__(self, level):
+        super().__init__(level)
+        self.lines = []
+
+    def emit(self, record):
+        try:
+            self.lines.append(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    timeout = 30
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+
+        try:
+            request = json.loads(line.decode('utf-8'))
+            response = self.server.run_request(request)
+        except Exception as e:
+            logger.exception('Bad request')
+            response = {'status': 1, 'stdout': '',
+                        'log': ['daemon error: %s' % str(e)]}
+
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+class Daemon(socketserver.UnixStreamServer):
+    # one request at a time: the server loop handles connections
+    # serially, so the pooled boards and the process-wide stdout,
+    # logging and cwd swaps below never race
+    def __init__(self, path, run, fmt, datefmt=None):
+        self.path = path
+        self.run = run
+        self.fmt = fmt
+        self.datefmt = datefmt
+        self.pool = KeyboardPool()
+
+        if path == socket_path() and \
+                not os.environ.get('XDG_RUNTIME_DIR'):
+            _private_dir(os.path.dirname(path))
+
+        if os.path.lexists(path):
+            if not _is_our_socket(path):
+                raise RuntimeError('%s exists and is not our socket' % path)
+            if is_running(path):
+                raise RuntimeError('Daemon already running on %s' % path)
+            os.unlink(path)
+
+        # bound under a umask rather than chmod()ed afterwards, so
+        # there's no moment when anyone else can connect
+        umask = os.umask(0o077)
+        try:
+            super().__init__(path, _RequestHandler)
+        finally:
+            os.umask(umask)
+
+    def run_request(self, request):
+        # run is cli.run(argv, pool=...), returning an exit status
+        handler = _CaptureHandler(
+            logging.DEBUG if request.get('debug') else logging.INFO)
+        handler.setFormatter(logging.Formatter(self.fmt, self.datefmt))
+
+        root = logging.getLogger()
+        old_level = root.level
+        root.addHandler(handler)
+        root.setLevel(min(old_level, handler.level))
+
+        stdout = io.StringIO()
+        cwd = os.getcwd()
+
+        try:
+            if request.get('cwd'):
+                os.chdir(request['cwd'])
+            with contextlib.redirect_stdout(stdout):
+                status = self.run(request['argv'], pool=self.pool)
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+        except Exception:
+            logging.exception('Request failed')
+            status = 1
+        finally:
+            self.pool.release()
+            os.chdir(cwd)
+            root.removeHandler(handler)
+            root.setLevel(old_level)
+
+        return {'status': status,
+                'stdout': stdout.getvalue(),
+                'log': handler.lines}
+
+    def server_close(self):
+        super().server_close()
+        self.pool.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def serve(path, run, fmt, datefmt=None):
+    server = Daemon(path, run, fmt, datefmt)
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever, so it can't run here
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+
+    logger.info('Listening on %s', path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+    return 0
+
+
+def _connect(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def is_running(path):
+    sock = _connect(path)
+    if sock is None:
+        return False
+    sock.close()
+    return True
+
+
+def call(argv, path=None, debug=False):
+    # runs argv in the daemon; None if there's no daemon to talk to
+    path = path or socket_path()
+    if not os.path.lexists(path):
+        return None
+    if not _is_our_socket(path):
+        logger.warning('Ignoring %s: not a socket owned by us', path)
+        return None
+
+    sock = _connect(path)
+    if sock is None:
+        return None
+
+    request = {'argv': argv, 'cwd': os.getcwd(), 'debug': debug}
+
+    with sock, sock.makefile('rwb') as f:
+        f.write(json.dumps(request).encode('utf-8') + b'\n')
+        f.flush()
+        line = f.readline()
+
+    if not line:
+        raise RuntimeError('No reply from daemon on %s' % path)
+
+    return json.loads(line.decode('utf-8'))
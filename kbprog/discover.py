@@ -1,6 +1,11 @@
+import os
+import re
+
 import hid
 import usb.core
 
+from kbprog import emulator, recording
+
 devices = {
     '5241:080a': {
         'name': 'Rama U80-A',
@@ -113,78 +118,170 @@ devices = {
 }
 
 
-def discover(match=None, use_hid=False):
+def _build_index():
+    # (vid, pid) and (vid, pid, bcdDevice) -> device info, so lookups
+    # don't need to format id strings for every device on the bus
+    index = {}
+    for did, device_info in devices.items():
+        parts = did.split(':')
+        key = (int(parts[0], 16), int(parts[1], 16))
+        if len(parts) > 2:
+            key += (int(parts[2].lstrip('v'), 16),)
+        index[key] = (did.rsplit(':v', 1)[0], device_info)
+    return index
+
+
+_index = _build_index()
+_product_ids = frozenset(key[:2] for key in _index)
+
+
+def rebuild_index():
+    # call after changing devices
+    global _index, _product_ids
+    _index = _build_index()
+    _product_ids = frozenset(key[:2] for key in _index)
+
+
+def _lookup(vid, pid, version, match):
+    found = _index.get((vid, pid, version)) or _index.get((vid, pid))
+    if found is None:
+        return None, None
+
+    did, device_info = found
+    if match is not None:
+        if match not in device_info['name'] and \
+           match not in device_info['tag']:
+            return None, None
+
+    return did, device_info
+
+
+def discover(match=None, use_hid=False, emulate=None, **emulate_args):
+    if emulate is not None:
+        return emulate_discover(emulate, **emulate_args)
     if not use_hid:
         return old_discover(match=match)
     return new_discover(match=match)
 
 
-def new_discover(match=None):
-    devs = hid.enumerate()
-    results = []
+# a usb port path, e.g. 1-2 or 3-1.4.2, as linux names the device
+# in sysfs and hidapi's libusb backend uses in its paths
+_USB_PORT = re.compile(r'^\d+-\d+(\.\d+)*$')
+
 
-    results_by_tag = {}
+def _hid_board(d):
+    # something shared by every hid interface of one physical board:
+    # its usb port where that can be worked out, else its serial
+    path = d['path']
+    if isinstance(path, bytes):
+        path = path.decode('latin1')
 
-    for d in devs:
-        did = f"{d['vendor_id']:04x}:{d['product_id']:04x}"
-        did_ver = f"{did}:v{d['release_number']:04x}"
+    if path.startswith('/dev/hidraw'):
+        sysfs = os.path.realpath(os.path.join(
+            '/sys/class/hidraw', os.path.basename(path), 'device'))
+        for part in reversed(sysfs.split(os.sep)):
+            if _USB_PORT.match(part):
+                return part
+    else:
+        port = path.split(':', 1)[0]
+        if _USB_PORT.match(port):
+            return port
 
-        device_info = devices.get(did_ver, devices.get(did))
+    return d.get('serial_number') or ''
 
-        if device_info is not None:
-            add = True
-            if match is not None:
-                if match not in device_info['name'] and \
-                   match not in device_info['tag']:
-                    add = False
 
-            if add:
-                if device_info['tag'] not in results_by_tag:
-                    struct = device_info
-                    struct['device'] = [d['path']]
-                    struct['id'] = did
-                    struct['use_hid'] = True
-                    results_by_tag[device_info['tag']] = struct
-                else:
-                    kb = results_by_tag[device_info['tag']]
-                    kb['device'].append(d['path'])
+def new_discover(match=None, enumerate_hid=hid.enumerate):
+    # one result per board, each with all of that board's interface
+    # paths for find_hidpath to probe
+    results_by_board = {}
 
-    return list(results_by_tag.values())
+    for d in enumerate_hid():
+        did, device_info = _lookup(d['vendor_id'], d['product_id'],
+                                   d['release_number'], match)
+        if device_info is None:
+            continue
 
+        board = (device_info['tag'], _hid_board(d))
+        if board not in results_by_board:
+            struct = dict(device_info)
+            struct['device'] = [d['path']]
+            struct['id'] = did
+            struct['version'] = d['release_number']
+            struct['use_hid'] = True
+            struct['board'] = board[1]
+            results_by_board[board] = struct
+        else:
+            kb = results_by_board[board]
+            kb['device'].append(d['path'])
+
+    return list(results_by_board.values())
+
+
+def old_discover(match=None, find=usb.core.find):
+    product_ids = _product_ids
+
+    def known(device):
+        return (device.idVendor, device.idProduct) in product_ids
 
-def old_discover(match=None):
-    devs = usb.core.find(find_all=True)
     results = []
 
-    for device in devs:
-        did = '%04x:%04x' % (device.idVendor, device.idProduct)
-        did_ver = '%04x:%04x:v%04x' % (device.idVendor,
-                                       device.idProduct,
-                                       device.bcdDevice)
+    for device in find(find_all=True, custom_match=known):
+        did, device_info = _lookup(device.idVendor, device.idProduct,
+                                   device.bcdDevice, match)
+        if device_info is None:
+            continue
 
-        device_info = devices.get(did_ver, devices.get(did))
+        if 'discover_version' in device_info:
+            if device.bcdDevice != device_info['discover_version']:
+                continue
 
-        if device_info is not None:
-            if 'discover_version' in device_info:
-                if device.bcdDevice != device_info['discover_version']:
-                    continue
+        struct = dict(device_info)
+        struct['device'] = device
+        struct['id'] = did
+        struct['version'] = device.bcdDevice
+        struct['use_hid'] = False
 
-            add = True
-            if match is not None:
-                if match not in device_info['name'] and \
-                   match not in device_info['tag']:
-                    add = False
+        results.append(struct)
+
+    return results
 
-            if add:
-                struct = device_info
-                struct['device'] = device
-                struct['id'] = did
-                struct['use_hid'] = False
 
-                results.append(struct)
+def emulate_discover(tag, count=1, **emulate_args):
+    for did, device_info in devices.items():
+        if device_info['tag'] == tag:
+            break
+    else:
+        raise RuntimeError('No known device with tag %s' % tag)
+
+    results = []
+    for idx in range(count):
+        struct = dict(device_info)
+        struct['device'] = emulator.EmulatedKeyboard(
+            device_info['rows'], device_info['cols'],
+            serial='%s-%d' % (tag, idx), **emulate_args)
+        struct['id'] = did
+        struct['version'] = 0
+        struct['use_hid'] = False
+        struct['emulated'] = True
+
+        results.append(struct)
 
     return results
 
 
+def replay_discover(path, realtime=False):
+    # a recorded session, standing in for the board it came from
+    device = recording.ReplayTransport(path, realtime=realtime)
+
+    struct = dict(device.header)
+    struct.pop('resend_on_retry', None)
+    struct.pop('default_timeout', None)
+    struct.pop('report_size', None)
+    struct['device'] = device
+    struct['emulated'] = True
+
+    return [struct]
+
+
 if __name__ == '__main__':
     print(discover())
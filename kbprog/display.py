@@ -1,9 +1,11 @@
 import logging
+import threading
 import time
 
 import pygame
 
 from kbprog import keys
+from kbprog.loader import LayerScheduler
 
 
 chooser_tabs = [
@@ -66,6 +68,11 @@ for item in chooser_tabs:
             if keyitem not in keys.key_to_bytes and keyitem is not None:
                 raise RuntimeError('Bad key: %s' % keyitem)
 
+# posted by the map loader thread
+LOAD_PROGRESS = pygame.USEREVENT + 1
+LAYER_LOADED = pygame.USEREVENT + 2
+MAP_LOADED = pygame.USEREVENT + 3
+
 
 class ProgramDisplay(object):
     def __init__(self, keymap, width=1024, height=768):
@@ -86,6 +93,8 @@ class ProgramDisplay(object):
         self.get_font()
 
         self.in_progress = False
+        self.loading = False
+        self.scheduler = None
 
         self.kb_hover = None
         self.kb_dirty = True
@@ -202,6 +211,40 @@ class ProgramDisplay(object):
             self.progress_update()
             pygame.display.update()
 
+    def load_map(self):
+        # runs on the loader thread, so only talks to the UI via events
+        def progress(percent):
+            pygame.event.post(pygame.event.Event(
+                LOAD_PROGRESS, percent=percent))
+
+        def layer_loaded(layer):
+            pygame.event.post(pygame.event.Event(
+                LAYER_LOADED, layer=layer))
+
+        error = None
+        try:
+            self.keymap.get_map(progress, layer_callback=layer_loaded,
+                                scheduler=self.scheduler)
+        except Exception as e:
+            self.logger.exception('Error loading map')
+            error = str(e)
+
+        pygame.event.post(pygame.event.Event(MAP_LOADED, error=error))
+
+    def on_map_loaded(self, error):
+        self.loading = False
+        self.end_progress()
+
+        if error is not None:
+            pygame.display.set_caption(
+                'Error loading "%s": %s' % (self.keymap.name, error))
+        else:
+            pygame.display.set_caption('Editing "%s"' % self.keymap.name)
+
+        self.action_tabs[0]['enabled'] = bool(self.keymap.dirtymap)
+        self.kb_dirty = True
+        self.action_dirty = True
+
     def program(self):
         pygame.display.set_caption('Programming "%s"' % self.keymap.name)
 
@@ -433,12 +476,13 @@ class ProgramDisplay(object):
         corrected_pos = (pos[0] - self.kb_r.x,
                          pos[1] - self.kb_r.y)
 
-        if self.selected_keymap != 0:
+        if self.selected_keymap != 0 and \
+                self.keymap.is_loaded(self.selected_layer):
             for item in self.keymap.keylist:
                 if item['keyrect'].collidepoint(corrected_pos):
                     self.keymap.set_key(
                         self.selected_layer, item, self.selected_keymap)
-                    self.action_tabs[0]['enabled'] = True
+                    self.action_tabs[0]['enabled'] = not self.loading
 
         self.selected_keymap = 0
         self.hover_keymap = 0
@@ -507,6 +551,8 @@ class ProgramDisplay(object):
 
         self.logger.debug('layer invalidated')
         self.selected_layer = which_layer
+        if self.loading:
+            self.scheduler.prioritize(which_layer)
         self.layer_dirty = True
         self.kb_dirty = True
 
@@ -547,6 +593,12 @@ class ProgramDisplay(object):
                                              keyrect.y + 2,
                                              keyrect.w - 4,
                                              keyrect.h - 4), 3)
+            elif self.keymap.is_changed(self.selected_layer, item):
+                pygame.draw.rect(screen, pygame.Color('yellow'),
+                                 pygame.Rect(keyrect.x + 2,
+                                             keyrect.y + 2,
+                                             keyrect.w - 4,
+                                             keyrect.h - 4), 3)
 
             pygame.draw.rect(screen, pygame.Color('white'), keyrect, 1)
 
@@ -582,12 +634,16 @@ class ProgramDisplay(object):
         pygame.display.set_caption(
             'Loading Keymap for "%s"' % self.keymap.name)
 
-        self.start_progress()
-        self.keymap.get_map(self.update_progress)
-        self.end_progress()
-        self.kb_dirty = True
+        if self.keymap.load_cached_map():
+            # show the last snapshot while the real map loads
+            self.kb_dirty = True
 
-        pygame.display.set_caption('Editing "%s"' % self.keymap.name)
+        self.start_progress()
+        self.loading = True
+        self.scheduler = LayerScheduler(self.keymap.layers,
+                                        first=self.selected_layer)
+        loader = threading.Thread(target=self.load_map, daemon=True)
+        loader.start()
 
         done = False
         while not done:
@@ -627,6 +683,17 @@ class ProgramDisplay(object):
                         elif self.action_tab_r.collidepoint(event.pos):
                             self.on_action_tab_mousedown(event.pos)
 
+                elif event.type == LOAD_PROGRESS:
+                    self.in_progress = True
+                    self.progress = min(event.percent, 1.0)
+                    self.progress_update()
+                    pygame.display.update()
+                elif event.type == LAYER_LOADED:
+                    if event.layer == self.selected_layer:
+                        self.kb_dirty = True
+                elif event.type == MAP_LOADED:
+                    self.on_map_loaded(event.error)
+
                 event = pygame.event.poll()
 
             refresh = False
@@ -0,0 +1,258 @@
+import collections
+import logging
+import random
+import time
+
+from kbprog import transport
+from kbprog.keyboard import Keyboard
+
+
+class EmulatedKeyboard(transport.Transport):
+    # VIA's id_unhandled
+    UNHANDLED = 0xff
+
+    # GET/SET_KEYBOARD_VALUE ids
+    VALUE_UPTIME = 0x01
+    VALUE_LAYOUT_OPTIONS = 0x02
+
+    resend_on_retry = True
+    default_timeout = 300
+
+    def __init__(self, rows, cols, layers=4, protocol=9,
+                 macro_count=16, macro_bytes=1024,
+                 latency=0.0, drop_rate=0.0, seed=None, serial='0',
+                 report_size=32):
+        self.serial = serial
+        self.report_size = report_size
+        self.rows = rows
+        self.cols = cols
+        self.layers = layers
+        self.protocol = protocol
+        self.macro_count = macro_count if protocol > 7 else 0
+        self.macro_bytes = macro_bytes if protocol > 7 else 0
+
+        # seconds of delay before each reply is readable, and the
+        # chance (0-1) that a reply never shows up at all
+        self.latency = latency
+        self.drop_rate = drop_rate
+
+        self.logger = logging.getLogger(__name__)
+        self.random = random.Random(seed)
+        self.started = time.monotonic()
+
+        self.pending = collections.deque()
+        self.in_bootloader = False
+        self.commands = collections.Counter()
+
+        self.eeprom_reset()
+
+        self.handlers = {
+            Keyboard.GET_PROTOCOL_VERSION: self.get_protocol_version,
+            Keyboard.GET_KEYBOARD_VALUE: self.get_keyboard_value,
+            Keyboard.SET_KEYBOARD_VALUE: self.set_keyboard_value,
+            Keyboard.DYNAMIC_KEYMAP_GET_KEYCODE: self.get_keycode,
+            Keyboard.DYNAMIC_KEYMAP_SET_KEYCODE: self.set_keycode,
+            Keyboard.DYNAMIC_KEYMAP_CLEAR_ALL: self.clear_all,
+            Keyboard.BACKLIGHT_CONFIG_SET_VALUE: self.backlight_set_value,
+            Keyboard.BACKLIGHT_CONFIG_GET_VALUE: self.backlight_get_value,
+            Keyboard.BACKLIGHT_CONFIG_SAVE: self.backlight_save,
+            Keyboard.EEPROM_RESET: self.eeprom_reset_command,
+            Keyboard.BOOTLOADER_JUMP: self.bootloader_jump,
+        }
+
+        if protocol > 7:
+            self.handlers.update({
+                Keyboard.DYNAMIC_KEYMAP_MACRO_GET_COUNT: self.macro_get_count,
+                Keyboard.DYNAMIC_KEYMAP_MACRO_GET_BUFFER_SIZE:
+                    self.macro_get_buffer_size,
+                Keyboard.DYNAMIC_KEYMAP_MACRO_GET_BUFFER:
+                    self.macro_get_buffer,
+                Keyboard.DYNAMIC_KEYMAP_MACRO_SET_BUFFER:
+                    self.macro_set_buffer,
+                Keyboard.DYNAMIC_KEYMAP_MACRO_RESET: self.macro_reset,
+                Keyboard.DYNAMIC_KEYMAP_GET_LAYER_COUNT: self.get_layer_count,
+                Keyboard.DYNAMIC_KEYMAP_GET_BUFFER: self.get_buffer,
+                Keyboard.DYNAMIC_KEYMAP_SET_BUFFER: self.set_buffer,
+            })
+
+    def default_keymap(self):
+        # something recognizable: letters on layer 0, KC_TRNS above
+        keymap = bytearray()
+        for layer in range(self.layers):
+            for pos in range(self.rows * self.cols):
+                keycode = 0x04 + (pos % 26) if layer == 0 else 0x01
+                keymap += bytearray([(keycode & 0xFF00) >> 8,
+                                     keycode & 0xFF])
+        return keymap
+
+    def eeprom_reset(self):
+        self.keymap = self.default_keymap()
+        self.macros = bytearray(self.macro_bytes)
+        self.backlight = {}
+        self.saved_backlight = {}
+        self.layout_options = 0
+
+    # -- transport
+
+    def write(self, data):
+        data = bytes(data)
+        if self.in_bootloader:
+            return len(data)
+
+        reply = self.handle(data)
+
+        if reply is None or self.random.random() < self.drop_rate:
+            self.logger.debug('Dropping reply to %02x', data[0])
+        else:
+            self.pending.append((time.monotonic() + self.latency, reply))
+
+        return len(data)
+
+    def read(self, size, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+
+        deadline = time.monotonic() + (timeout / 1000.0)
+
+        if not self.pending:
+            time.sleep(timeout / 1000.0)
+            return b''
+
+        ready_at, reply = self.pending[0]
+        if ready_at > deadline:
+            # reply is late, leave it queued for the next read
+            time.sleep(timeout / 1000.0)
+            return b''
+
+        self.pending.popleft()
+        delay = ready_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+        return reply[:size]
+
+    # -- command handling
+
+    def handle(self, data):
+        command = data[0]
+        self.commands[command] += 1
+
+        reply = bytearray(data)
+        handler = self.handlers.get(command)
+        if handler is None:
+            reply[0] = self.UNHANDLED
+            return bytes(reply)
+
+        return handler(data, reply)
+
+    @staticmethod
+    def _offset(data):
+        return data[1] << 8 | data[2]
+
+    def get_protocol_version(self, data, reply):
+        reply[1] = (self.protocol & 0xFF00) >> 8
+        reply[2] = self.protocol & 0xFF
+        return bytes(reply)
+
+    def get_keyboard_value(self, data, reply):
+        if data[1] == self.VALUE_UPTIME:
+            uptime = int((time.monotonic() - self.started) * 1000)
+            reply[2:6] = uptime.to_bytes(4, 'big')
+        elif data[1] == self.VALUE_LAYOUT_OPTIONS:
+            reply[2:6] = self.layout_options.to_bytes(4, 'big')
+        else:
+            reply[0] = self.UNHANDLED
+        return bytes(reply)
+
+    def set_keyboard_value(self, data, reply):
+        if data[1] == self.VALUE_LAYOUT_OPTIONS:
+            self.layout_options = int.from_bytes(data[2:6], 'big')
+        else:
+            reply[0] = self.UNHANDLED
+        return bytes(reply)
+
+    def _key_index(self, layer, row, col):
+        if layer >= self.layers or row >= self.rows or col >= self.cols:
+            return None
+        return ((layer * self.rows * self.cols) + (row * self.cols) + col) * 2
+
+    def get_keycode(self, data, reply):
+        idx = self._key_index(data[1], data[2], data[3])
+        if idx is not None:
+            reply[4:6] = self.keymap[idx:idx + 2]
+        return bytes(reply)
+
+    def set_keycode(self, data, reply):
+        idx = self._key_index(data[1], data[2], data[3])
+        if idx is not None:
+            self.keymap[idx:idx + 2] = data[4:6]
+        return bytes(reply)
+
+    def clear_all(self, data, reply):
+        self.keymap = self.default_keymap()
+        return bytes(reply)
+
+    def backlight_set_value(self, data, reply):
+        self.backlight[data[1]] = bytes(data[2:])
+        return bytes(reply)
+
+    def backlight_get_value(self, data, reply):
+        value = self.backlight.get(data[1], b'')
+        reply[2:2 + len(value)] = value
+        return bytes(reply)
+
+    def backlight_save(self, data, reply):
+        self.saved_backlight = dict(self.backlight)
+        return bytes(reply)
+
+    def eeprom_reset_command(self, data, reply):
+        self.eeprom_reset()
+        return bytes(reply)
+
+    def bootloader_jump(self, data, reply):
+        # the board drops off the bus, so nothing comes back
+        self.in_bootloader = True
+        return None
+
+    def macro_get_count(self, data, reply):
+        reply[1] = self.macro_count
+        return bytes(reply)
+
+    def macro_get_buffer_size(self, data, reply):
+        reply[1] = (self.macro_bytes & 0xFF00) >> 8
+        reply[2] = self.macro_bytes & 0xFF
+        return bytes(reply)
+
+    def _read_range(self, buffer, data, reply):
+        offset = self._offset(data)
+        size = data[3]
+        if offset + size <= len(buffer) and size <= len(reply) - 4:
+            reply[4:4 + size] = buffer[offset:offset + size]
+        return bytes(reply)
+
+    def _write_range(self, buffer, data, reply):
+        offset = self._offset(data)
+        size = data[3]
+        if offset + size <= len(buffer) and size <= len(data) - 4:
+            buffer[offset:offset + size] = data[4:4 + size]
+        return bytes(reply)
+
+    def macro_get_buffer(self, data, reply):
+        return self._read_range(self.macros, data, reply)
+
+    def macro_set_buffer(self, data, reply):
+        return self._write_range(self.macros, data, reply)
+
+    def macro_reset(self, data, reply):
+        self.macros = bytearray(self.macro_bytes)
+        return bytes(reply)
+
+    def get_layer_count(self, data, reply):
+        reply[1] = self.layers
+        return bytes(reply)
+
+    def get_buffer(self, data, reply):
+        return self._read_range(self.keymap, data, reply)
+
+    def set_buffer(self, data, reply):
+        return self._write_range(self.keymap, data, reply)
@@ -0,0 +1,117 @@
+import logging
+import time
+
+from kbprog import discover
+
+try:
+    import pyudev
+except ImportError:
+    pyudev = None
+
+
+logger = logging.getLogger(__name__)
+
+
+def device_key(info):
+    # something stable for as long as the board stays plugged in
+    if info.get('emulated'):
+        return ('emulated', info['device'].serial)
+    if info['use_hid']:
+        # not the interface paths, which turn up one at a time as a
+        # board's hidraw nodes are created
+        return ('hid', info['tag'], info['board'])
+    return ('usb', info['device'].bus, info['device'].address)
+
+
+def _scan(match, use_hid):
+    results = discover.discover(match=match, use_hid=use_hid)
+    return {device_key(info): info for info in results}
+
+
+def _diff(known, current):
+    events = []
+    for key in known.keys() - current.keys():
+        events.append(('detach', known[key]))
+    for key in current.keys() - known.keys():
+        events.append(('attach', current[key]))
+    return events
+
+
+def _is_known_product(device):
+    # PRODUCT looks like "5241/80a/1" on usb devices and interfaces
+    product = device.get('PRODUCT')
+    if product is None:
+        return False
+
+    try:
+        vid, pid = [int(x, 16) for x in product.split('/')[:2]]
+    except ValueError:
+        return False
+
+    return (vid, pid) in discover._product_ids
+
+
+def _udev_changes(use_hid, interval):
+    context = pyudev.Context()
+    monitor = pyudev.Monitor.from_netlink(context)
+    if use_hid:
+        monitor.filter_by('hidraw')
+    else:
+        monitor.filter_by('usb', device_type='usb_device')
+    monitor.start()
+
+    while True:
+        device = monitor.poll(timeout=interval)
+        if device is None:
+            yield False
+        elif device.action not in ('add', 'remove'):
+            yield False
+        elif use_hid:
+            # the usb parent is already gone on remove, so any hidraw
+            # change means rescanning
+            yield True
+        else:
+            yield _is_known_product(device)
+
+
+def _poll_changes(interval):
+    while True:
+        time.sleep(interval)
+        yield True
+
+
+def watch(match=None, use_hid=False, interval=1.0, use_udev=True,
+          timeout=None):
+    # yields ('attach', info) and ('detach', info) as known boards come
+    # and go, with the same info dicts discover() returns.  Boards
+    # already plugged in are reported as attached first.  Uses udev
+    # when pyudev is around, otherwise rescans every interval seconds.
+    # With a timeout, yields (None, None) whenever that many seconds
+    # pass quietly, so callers get a chance to stop.
+    known = _scan(match, use_hid)
+    for info in known.values():
+        yield 'attach', info
+
+    if use_udev and pyudev is not None:
+        logger.debug('Watching for devices with udev')
+        changes = _udev_changes(use_hid, interval)
+    else:
+        logger.debug('Polling for devices every %ss', interval)
+        changes = _poll_changes(interval)
+
+    last_event = time.monotonic()
+
+    for changed in changes:
+        if changed:
+            current = _scan(match, use_hid)
+            events = _diff(known, current)
+            known = current
+
+            for event in events:
+                last_event = time.monotonic()
+                yield event
+
+        if timeout is not None and \
+                time.monotonic() - last_event >= timeout:
+            last_event = time.monotonic()
+            yield None, None
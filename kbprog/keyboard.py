@@ -1,8 +1,29 @@
 import logging
+import threading
+import time
 
 import hid
 import usb.util
 
+from kbprog import packet, rtt, stats, transport
+from kbprog.keymap import Keymap
+
+
+def board_identity(kbinfo):
+    # which board this is, from what discover found, so the map cache
+    # can be looked up without a word to the board
+    device = kbinfo['device']
+    if kbinfo.get('emulated'):
+        where = 'emulated:%s' % device.serial
+    elif kbinfo['use_hid']:
+        where = 'hid:%s' % kbinfo.get('board', '')
+    else:
+        ports = '.'.join(str(x) for x in (device.port_numbers or []))
+        where = 'usb:%s-%s' % (device.bus, ports)
+
+    return '%s:v%04x:%s' % (kbinfo.get('id'), kbinfo.get('version') or 0,
+                            where)
+
 
 class Keyboard(object):
     # -- start commands
@@ -31,6 +52,43 @@ class Keyboard(object):
     DYNAMIC_KEYMAP_SET_BUFFER = 0x13
     # -- end commands
 
+    COMMAND_NAMES = {
+        GET_PROTOCOL_VERSION: 'GET_PROTOCOL_VERSION',
+        GET_KEYBOARD_VALUE: 'GET_KEYBOARD_VALUE',
+        SET_KEYBOARD_VALUE: 'SET_KEYBOARD_VALUE',
+        DYNAMIC_KEYMAP_GET_KEYCODE: 'DYNAMIC_KEYMAP_GET_KEYCODE',
+        DYNAMIC_KEYMAP_SET_KEYCODE: 'DYNAMIC_KEYMAP_SET_KEYCODE',
+        DYNAMIC_KEYMAP_CLEAR_ALL: 'DYNAMIC_KEYMAP_CLEAR_ALL',
+        BACKLIGHT_CONFIG_SET_VALUE: 'BACKLIGHT_CONFIG_SET_VALUE',
+        BACKLIGHT_CONFIG_GET_VALUE: 'BACKLIGHT_CONFIG_GET_VALUE',
+        BACKLIGHT_CONFIG_SAVE: 'BACKLIGHT_CONFIG_SAVE',
+        EEPROM_RESET: 'EEPROM_RESET',
+        BOOTLOADER_JUMP: 'BOOTLOADER_JUMP',
+        DYNAMIC_KEYMAP_MACRO_GET_COUNT: 'DYNAMIC_KEYMAP_MACRO_GET_COUNT',
+        DYNAMIC_KEYMAP_MACRO_GET_BUFFER_SIZE:
+        'DYNAMIC_KEYMAP_MACRO_GET_BUFFER_SIZE',
+        DYNAMIC_KEYMAP_MACRO_GET_BUFFER: 'DYNAMIC_KEYMAP_MACRO_GET_BUFFER',
+        DYNAMIC_KEYMAP_MACRO_SET_BUFFER: 'DYNAMIC_KEYMAP_MACRO_SET_BUFFER',
+        DYNAMIC_KEYMAP_MACRO_RESET: 'DYNAMIC_KEYMAP_MACRO_RESET',
+        DYNAMIC_KEYMAP_GET_LAYER_COUNT: 'DYNAMIC_KEYMAP_GET_LAYER_COUNT',
+        DYNAMIC_KEYMAP_GET_BUFFER: 'DYNAMIC_KEYMAP_GET_BUFFER',
+        DYNAMIC_KEYMAP_SET_BUFFER: 'DYNAMIC_KEYMAP_SET_BUFFER',
+    }
+
+    # reply to a command the firmware doesn't know about
+    UNHANDLED = 0xff
+
+    # commands whose reply echoes the request's bytes 1-3 (offset,
+    # size or layer/row/col) so it can be matched to its request
+    ECHO_COMMANDS = (
+        DYNAMIC_KEYMAP_GET_KEYCODE,
+        DYNAMIC_KEYMAP_SET_KEYCODE,
+        DYNAMIC_KEYMAP_MACRO_GET_BUFFER,
+        DYNAMIC_KEYMAP_MACRO_SET_BUFFER,
+        DYNAMIC_KEYMAP_GET_BUFFER,
+        DYNAMIC_KEYMAP_SET_BUFFER,
+    )
+
     # -- start backlight values ids
     # protocol "alpha"
     BACKLIGHT_USE_SPLIT_BACKSPACE = 0x01
@@ -66,28 +124,110 @@ class Keyboard(object):
         9: 'gamma'
     }
 
+    # what each protocol version can do.  Versions in between or past
+    # these get the features of the closest older one.
+    PROTOCOL_FEATURES = {
+        7: {'layer_count': False,
+            'macros': False,
+            'keymap_buffer': False},
+        8: {'layer_count': True,
+            'macros': True,
+            'keymap_buffer': True},
+        9: {'layer_count': True,
+            'macros': True,
+            'keymap_buffer': True},
+    }
+
+    # layers on boards that can't be asked (no layer_count)
+    DEFAULT_LAYERS = 3
+
     BL_PROTOCOLS = {
         0: 'none',
         1: 'wilba'
     }
 
-    def __init__(self, device, name, tag, rows, cols, use_hid, **kwargs):
+    # writes that are checked with the matching read before being sent
+    # again, after their reply goes missing
+    VERIFY_COMMANDS = {
+        DYNAMIC_KEYMAP_SET_KEYCODE: DYNAMIC_KEYMAP_GET_KEYCODE,
+        DYNAMIC_KEYMAP_MACRO_SET_BUFFER: DYNAMIC_KEYMAP_MACRO_GET_BUFFER,
+        DYNAMIC_KEYMAP_SET_BUFFER: DYNAMIC_KEYMAP_GET_BUFFER,
+    }
+
+    # commands that are never sent twice
+    UNSAFE_COMMANDS = (
+        DYNAMIC_KEYMAP_CLEAR_ALL,
+        BACKLIGHT_CONFIG_SAVE,
+        EEPROM_RESET,
+        BOOTLOADER_JUMP,
+        DYNAMIC_KEYMAP_MACRO_RESET,
+    )
+
+    # tries per command; anything not above is an idempotent read or
+    # an absolute set, and is safe to repeat
+    READ_ATTEMPTS = 3
+    WRITE_ATTEMPTS = 2
+
+    # ms to wait on each candidate hid path; most of them aren't raw
+    # hid and never answer, and one that is answers in a few ms
+    PROBE_TIMEOUT = 100
+
+    # command/offset/size header on buffer commands; the rest of a
+    # report is payload, 28 bytes on the usual 32 byte reports
+    BUFFER_HEADER_SIZE = 4
+
+    def __init__(self, device, name, tag, rows, cols, use_hid,
+                 emulated=False, pipeline=1, offline=None, **kwargs):
+        # offline is a map cache entry: the board is never opened, and
+        # its protocol, layer count and report size come from there
         self.name = name
         self.tag = tag
         self.rows = rows
         self.cols = cols
 
+        # vid:pid and bcdDevice/release number, as found by discover
+        self.device_id = kwargs.get('id')
+        self.version = kwargs.get('version')
+        self.hid_path = None
+        self.identity = board_identity(dict(kwargs, device=device,
+                                            use_hid=use_hid,
+                                            emulated=emulated))
+
         self.logger = logging.getLogger(__name__)
+        self.stats = stats.CommandStats(self.COMMAND_NAMES)
+        # adaptive read timeouts, per command id
+        self.rtt = {}
 
+        # serializes commands from the editor and its loader thread
+        self.lock = threading.RLock()
+
+        # capabilities, fetched from the device on first use
+        self._protocol = None
+        self._features = None
         self._layers = None
         self._macro_buffer_size = None
         self._macro_count = None
-        self.macros = []
+        self._macros = None
+        # what the macro buffer is known to hold, from the last read
+        # or write
+        self._macro_buffer = bytearray()
+
+        # number of requests kept in flight for bulk reads
+        self.pipeline = pipeline
 
         self.use_hid = use_hid
+        self.emulated = emulated
         self.device = device
 
-        if not self.use_hid:
+        if offline is not None:
+            self._protocol = offline['protocol']
+            self._layers = offline['layers']
+            self.set_transport(transport.OfflineTransport(
+                offline['report_size']))
+        elif self.emulated:
+            # emulated devices are their own transport
+            self.set_transport(self.device)
+        elif not self.use_hid:
             self.find_endpoint()
 
             if self.device.is_kernel_driver_active(self.interface):
@@ -99,11 +239,43 @@ class Keyboard(object):
             except Exception as e:
                 self.logger.debug('Could not claim device: %s',
                                   str(e))
+
+            self.set_transport(transport.UsbTransport(
+                self.device, self.in_ep, self.out_ep,
+                report_size=self.max_packet_size,
+                interface=self.interface))
         else:
             self.find_hidpath()
 
-        self.protocol = self.get_protocol()
-        self._load_macros()
+    def set_transport(self, new_transport):
+        # packets are sized to whatever the transport's reports are
+        self.transport = new_transport
+        self.report_size = new_transport.report_size
+        self.chunk_size = min(self.report_size - self.BUFFER_HEADER_SIZE,
+                              0xff)
+        self.codec = packet.PacketCodec(self.report_size)
+
+    @property
+    def device_path(self):
+        if self.emulated:
+            return 'emulated:%s' % self.device.serial
+        if self.use_hid:
+            path = self.hid_path
+            if isinstance(path, bytes):
+                path = path.decode('latin1')
+            return path
+
+        try:
+            serial = usb.util.get_string(self.device,
+                                         self.device.iSerialNumber)
+        except Exception:
+            serial = None
+
+        if serial:
+            return 'serial:%s' % serial
+
+        ports = '.'.join(str(x) for x in (self.device.port_numbers or []))
+        return 'usb:%s-%s' % (self.device.bus, ports)
 
     def dump(self):
         self.logger.info('Name: %s', self.name)
@@ -119,6 +291,21 @@ class Keyboard(object):
             for idx, macro in enumerate(self.macros):
                 self.logger.info('Macro %d: %s', idx, macro)
 
+    def invalidate(self):
+        # forget memoised capabilities and macros, e.g. after a reset
+        self._protocol = None
+        self._features = None
+        self.forget_contents()
+
+    def forget_contents(self):
+        # just what the board holds, which anything else (VIA, another
+        # kbprog, a reset) may have changed since it was read
+        self._layers = None
+        self._macro_buffer_size = None
+        self._macro_count = None
+        self._macros = None
+        self._macro_buffer = bytearray()
+
     def get_protocol(self):
         result = self._send_command(self.GET_PROTOCOL_VERSION)
         retval = (result[1] * 256) + result[2]
@@ -130,186 +317,269 @@ class Keyboard(object):
     def save(self):
         self._send_command(self.BACKLIGHT_CONFIG_SAVE)
 
+    @property
+    def protocol(self):
+        if self._protocol is None:
+            self._protocol = self.get_protocol()
+        return self._protocol
+
+    def supports(self, feature):
+        if self._features is None:
+            known = [version for version in self.PROTOCOL_FEATURES
+                     if version <= self.protocol]
+            version = max(known) if known else min(self.PROTOCOL_FEATURES)
+            self._features = self.PROTOCOL_FEATURES[version]
+        return self._features.get(feature, False)
+
     @property
     def layers(self):
         if self._layers is None:
-            if self.protocol == 7:
-                self._layers = 3
-            result = self._send_command(self.DYNAMIC_KEYMAP_GET_LAYER_COUNT)
-            self._layers = result[1]
+            if not self.supports('layer_count'):
+                self._layers = self.DEFAULT_LAYERS
+            else:
+                result = self._send_command(
+                    self.DYNAMIC_KEYMAP_GET_LAYER_COUNT)
+                self._layers = result[1]
         return self._layers
 
     @property
     def macro_bytes(self):
-        if self.protocol == 7:
-            self._macro_buffer_size = 0
-        else:
-            result = self._send_command(
-                self.DYNAMIC_KEYMAP_MACRO_GET_BUFFER_SIZE)
-            self._macro_buffer_size = result[1] << 8 | result[2]
+        if self._macro_buffer_size is None:
+            if not self.supports('macros'):
+                self._macro_buffer_size = 0
+            else:
+                result = self._send_command(
+                    self.DYNAMIC_KEYMAP_MACRO_GET_BUFFER_SIZE)
+                self._macro_buffer_size = result[1] << 8 | result[2]
         return self._macro_buffer_size
 
     @property
     def macro_count(self):
-        if self.protocol == 7:
-            self._macro_count = 0
-        else:
-            result = self._send_command(self.DYNAMIC_KEYMAP_MACRO_GET_COUNT)
-            self._macro_count = result[1]
+        if self._macro_count is None:
+            if not self.supports('macros'):
+                self._macro_count = 0
+            else:
+                result = self._send_command(
+                    self.DYNAMIC_KEYMAP_MACRO_GET_COUNT)
+                self._macro_count = result[1]
         return self._macro_count
 
+    @property
+    def macros(self):
+        # only read off the device when something asks for them
+        if self._macros is None:
+            self._macros = self._load_macros()
+        return self._macros
+
     def set_macro(self, index, value):
-        if index > self.macro_count:
+        if index >= self.macro_count:
             raise RuntimeError('Macro %d out of range' % index)
 
         value = bytes(value, 'latin1').decode('unicode_escape')
         self.macros[index] = value
 
     def _load_macros(self):
+        macros = []
         if self.macro_count == 0:
-            return
+            return macros
 
         macro_bytes = self.macro_bytes
         if not macro_bytes:
-            return
+            return macros
 
+        # read a pipeline's worth of chunks at a time, and stop as soon
+        # as every macro's terminator has turned up
+        batch = max(self.pipeline, 1) * self.chunk_size
         buffer = bytearray()
-        left_to_read = macro_bytes
-        offset = 0
-
-        while(left_to_read):
-            to_read = min(left_to_read, 28)
-            next = self._send_command(
-                self.DYNAMIC_KEYMAP_MACRO_GET_BUFFER,
-                (offset & 0xFF00) >> 8,
-                offset & 0xFF,
-                to_read & 0xFF)
-
-            data = next[4:4+to_read]
+        terminators = 0
+
+        while len(buffer) < macro_bytes and terminators < self.macro_count:
+            size = min(batch, macro_bytes - len(buffer))
+            data = self._read_buffer(self.DYNAMIC_KEYMAP_MACRO_GET_BUFFER,
+                                     size, start=len(buffer))
+            terminators += data.count(0)
             buffer += data
-            left_to_read -= to_read
-            offset += to_read
 
-        macro = 0
-        current_macro = bytearray()
-        offset = 0
+        self.logger.debug('Read %d of %d macro bytes', len(buffer),
+                          macro_bytes)
+        self._macro_buffer = buffer
 
-        while(macro < self.macro_count):
-            if buffer[offset] != 0:
-                current_macro.append(buffer[offset])
-            else:
-                self.logger.debug('Macro %d: %s', macro, current_macro)
-                self.macros.append(current_macro.decode('latin1'))
-                current_macro = bytearray()
-                macro += 1
+        parts = bytes(buffer).split(b'\0', self.macro_count)
+        for macro, value in enumerate(parts[:self.macro_count]):
+            self.logger.debug('Macro %d: %s', macro, value)
+            macros.append(value.decode('latin1'))
+
+        # a full buffer without enough terminators
+        while len(macros) < self.macro_count:
+            macros.append('')
+
+        return macros
+
+    def _macro_writes(self, buffer):
+        # (offset, size) runs of buffer that differ from what the board
+        # is known to hold, each small enough for one MACRO_SET_BUFFER.
+        # Unchanged bytes between changes in a run go along for free.
+        known = self._macro_buffer
+        if known[:len(buffer)] == buffer:
+            return []
+
+        chunk = self.chunk_size
+        writes = []
+        start = None
+        end = 0
+
+        for offset in range(len(buffer)):
+            if offset < len(known) and buffer[offset] == known[offset]:
+                continue
+            if start is not None and offset - start < chunk:
+                end = offset + 1
+                continue
+            if start is not None:
+                writes.append((start, end - start))
+            start = offset
+            end = offset + 1
+
+        if start is not None:
+            writes.append((start, end - start))
 
-            offset += 1
+        return writes
 
     def save_macros(self):
         macro_bytes = self.macro_bytes
         if not macro_bytes:
-            return
+            return 0
 
         buffer = bytearray()
-        for macro in range(self.macro_count):
-            buffer += bytearray(self.macros[macro].encode('latin1'))
+        for macro in self.macros[:self.macro_count]:
+            buffer += bytearray(macro.encode('latin1'))
             buffer.append(0)
 
-        if len(buffer) > self.macro_bytes:
+        if len(buffer) > macro_bytes:
             raise RuntimeError('macro too large')
 
-        left_to_write = len(buffer)
-        offset = 0
+        writes = self._macro_writes(buffer)
 
-        while(left_to_write):
-            to_write = min(left_to_write, 28)
-            self._send_command(
-                self.DYNAMIC_KEYMAP_MACRO_SET_BUFFER,
-                (offset & 0xFF00) >> 8,
-                offset & 0xFF,
-                to_write & 0xFF,
-                buffer[offset:offset+to_write])
+        for offset, size in writes:
+            self._send_offset(self.DYNAMIC_KEYMAP_MACRO_SET_BUFFER,
+                              offset, size, buffer[offset:offset+size])
+            known = self._macro_buffer
+            if len(known) < offset + size:
+                known.extend(bytes(offset + size - len(known)))
+            known[offset:offset+size] = buffer[offset:offset+size]
 
-            left_to_write -= to_write
-            offset += to_write
+        self.logger.info('Wrote %d of %d macro bytes in %d writes',
+                         sum(size for _, size in writes), len(buffer),
+                         len(writes))
+
+        return len(writes)
 
     def set_key(self, layer, row, col, value):
         self._send_command(
             self.DYNAMIC_KEYMAP_SET_KEYCODE,
             layer, row, col, (value & 0xFF00) >> 8, value & 0xFF)
 
-    def keyboard_map_beta(self, callback=None):
-        buffer = bytearray()
-
-        buffer_size = self.layers * self.rows * self.cols * 2
-        left_to_read = buffer_size
-        offset = 0
-
-        while(left_to_read):
-            to_read = min(left_to_read, 28)
-            next = self._send_command(
-                self.DYNAMIC_KEYMAP_GET_BUFFER,
-                (offset & 0xFF00) >> 8,
-                offset & 0xFF,
-                to_read & 0xFF)
-
-            data = next[4:4+to_read]
-            buffer += data
-            left_to_read -= to_read
-            offset += to_read
+    def set_buffer(self, offset, data):
+        if len(data) > self.chunk_size:
+            raise RuntimeError('Buffer write too large: %d' % len(data))
+
+        self._send_offset(self.DYNAMIC_KEYMAP_SET_BUFFER,
+                          offset, len(data), data)
+
+    def _read_ranges(self, command, ranges, callback=None):
+        # ranges is a list of (offset, size) byte ranges, all fetched
+        # in one batch so they share the pipeline
+        commands = []
+        total_size = 0
+
+        for start, size in ranges:
+            offset = start
+            end = start + size
+            while offset < end:
+                to_read = min(end - offset, self.chunk_size)
+                commands.append((command,
+                                 (offset & 0xFF00) >> 8,
+                                 offset & 0xFF,
+                                 to_read & 0xFF))
+                offset += to_read
+            total_size += size
+
+        def progress(done):
+            read = min(done * self.chunk_size, total_size)
+            callback(float(read) / float(total_size))
+
+        results = self._send_commands(
+            commands, callback=progress if callback is not None else None)
+
+        buffers = []
+        results = iter(zip(commands, results))
+        for start, size in ranges:
+            buffer = bytearray(size)
+            view = memoryview(buffer)
+            offset = 0
+            while offset < size:
+                (_, _, _, to_read), result = next(results)
+                view[offset:offset+to_read] = bytes(result[4:4+to_read])
+                offset += to_read
+            buffers.append(buffer)
+
+        return buffers
+
+    def _read_buffer(self, command, buffer_size, callback=None, start=0):
+        return self._read_ranges(command, [(start, buffer_size)],
+                                 callback=callback)[0]
+
+    def layer_range(self, layer):
+        layer_size = self.rows * self.cols * 2
+        return (layer * layer_size, layer_size)
+
+    def read_keymap(self, ranges, callback=None):
+        # byte ranges of the keymap buffer, as laid out by
+        # DYNAMIC_KEYMAP_GET_BUFFER, regardless of protocol
+        if self.supports('keymap_buffer'):
+            return self._read_ranges(self.DYNAMIC_KEYMAP_GET_BUFFER,
+                                     ranges, callback=callback)
+
+        buffers = []
+        total_items = sum(size // 2 for _, size in ranges)
+        read = 0
 
-            if callback is not None:
-                read = buffer_size - left_to_read
-                percent = float(read) / float(buffer_size)
-                callback(percent)
+        for start, size in ranges:
+            buffer = bytearray()
+            for pos in range(start // 2, (start + size) // 2):
+                layer, rest = divmod(pos, self.rows * self.cols)
+                row, col = divmod(rest, self.cols)
+                result = self._send_command(
+                    self.DYNAMIC_KEYMAP_GET_KEYCODE,
+                    layer, row, col)
+                buffer += bytearray(result[4:6])
+                read += 1
 
-        self.logger.debug('Map: %s bytes (expected %s): %s',
-                          len(buffer),
-                          self.layers * self.rows * self.cols * 2,
-                          ' '.join('%02x' % x for x in buffer))
-
-        # now, split it out
-        items = []
-        pos = 0
-        for layer in range(self.layers):
-            items.append([])
-            for row in range(self.rows):
-                items[layer].append([])
-                for col in range(self.cols):
-                    items[layer][row].append(
-                        buffer[pos] << 8 | buffer[pos+1])
-                    pos += 2
-
-        return items
+                if callback is not None:
+                    callback(float(read) / float(total_items))
 
-    def keyboard_map(self, callback=None):
-        if self.protocol > 7:  # beta or better
-            return self.keyboard_map_beta(callback=callback)
+            buffers.append(buffer)
 
-        items = []
+        return buffers
 
-        total_items = self.layers * self.rows * self.cols
-        read = 0
+    def keyboard_map_beta(self, callback=None):
+        buffer_size = self.layers * self.rows * self.cols * 2
+        buffer = self._read_buffer(self.DYNAMIC_KEYMAP_GET_BUFFER,
+                                   buffer_size, callback=callback)
 
-        for layer in range(self.layers):
-            items.append([])
+        self.logger.debug('Map: %s bytes (expected %s): %s',
+                          len(buffer), buffer_size,
+                          packet.HexDump(buffer))
 
-            for row in range(self.rows):
-                items[layer].append([])
-                self.logger.debug('Reading layer %d, row %d' % (layer, row))
+        return Keymap.from_bytes(buffer, self.layers, self.rows, self.cols)
 
-                for col in range(self.cols):
-                    result = self._send_command(
-                        self.DYNAMIC_KEYMAP_GET_KEYCODE,
-                        layer, row, col)
-                    items[layer][row].append(result[4] * 256 + result[5])
-                    read += 1
+    def keyboard_map(self, callback=None):
+        if self.supports('keymap_buffer'):
+            return self.keyboard_map_beta(callback=callback)
 
-                    if callback is not None:
-                        percent = float(read) / float(total_items)
-                        callback(percent)
+        buffer_size = self.layers * self.rows * self.cols * 2
+        buffer = self.read_keymap([(0, buffer_size)], callback=callback)[0]
 
-        return items
+        return Keymap.from_bytes(buffer, self.layers, self.rows, self.cols)
 
     @property
     def effect(self):
@@ -322,71 +592,275 @@ class Keyboard(object):
         self._send_command(self.BACKLIGHT_CONFIG_SET_VALUE,
                            self.BACKLIGHT_EFFECT, value)
 
+    def _encode(self, *args):
+        return self.codec.encode(*args)
+
+    def _reply_matches(self, out_buf, in_buf):
+        if in_buf[0] not in (out_buf[0], self.UNHANDLED):
+            return False
+        if out_buf[0] in self.ECHO_COMMANDS:
+            return bytes(in_buf[1:4]) == bytes(out_buf[1:4])
+        return True
+
     def _send_command(self, *args):
-        bufsize = 32
-        out_buf = [0x00] * bufsize
-        ofs = 0
-
-        for item in args:
-            if isinstance(item, int):
-                out_buf[ofs] = item
-                ofs += 1
-            elif isinstance(item, str):
-                for char in item:
-                    out_buf[ofs] = ord(char)
-                    ofs += 1
-            elif isinstance(item, bytearray):
-                for char in item:
-                    out_buf[ofs] = char
-                    ofs += 1
+        with self.lock:
+            return self._send_packet(self._encode(*args))
+
+    def _send_offset(self, command, offset, size, data=None):
+        with self.lock:
+            return self._send_packet(self.codec.encode_offset(
+                command, offset, size, data))
+
+    def _estimator(self, command):
+        estimator = self.rtt.get(command)
+        if estimator is None:
+            estimator = self.rtt[command] = rtt.RttEstimator(
+                self.transport.default_timeout)
+        return estimator
+
+    def timing(self):
+        # what the adaptive read timeouts have learned, per command
+        return {self.stats.name(command): estimator.report()
+                for command, estimator in sorted(self.rtt.items())}
+
+    def _wait_reply(self, out_buf, timeout):
+        # the reply to out_buf, or empty on timeout, skipping replies
+        # that arrived after an earlier timeout
+        stale = 0
+        in_buf = self.transport.read(self.report_size, timeout)
+        while len(in_buf) != 0 and not self._reply_matches(out_buf, in_buf):
+            self.logger.debug('Discarding stale reply: %s',
+                              packet.HexDump(in_buf))
+            stale += 1
+            in_buf = self.transport.read(self.report_size, timeout)
+        return in_buf, stale
+
+    def _verify_write(self, out_buf):
+        # read back what a write whose reply went missing should have
+        # changed.  Returns the reply the write would have had if it
+        # landed, else None.
+        command = out_buf[0]
+        if command == self.DYNAMIC_KEYMAP_SET_KEYCODE:
+            result = self._send_packet(self._encode(
+                self.DYNAMIC_KEYMAP_GET_KEYCODE, *out_buf[1:4]))
+            landed = bytes(result[4:6]) == bytes(out_buf[4:6])
+        else:
+            _, offset, size = self.codec.decode_offset(out_buf)
+            result = self._send_packet(self.codec.encode_offset(
+                self.VERIFY_COMMANDS[command], offset, size))
+            landed = bytes(result[4:4 + size]) == bytes(out_buf[4:4 + size])
+
+        self.logger.debug('Write %s after a timeout: %s',
+                          'landed' if landed else 'lost',
+                          packet.HexDump(out_buf))
+        if landed:
+            # set commands echo the request
+            return bytes(out_buf)
+        return None
+
+    def _send_packet(self, out_buf):
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            self.logger.debug('Send: %d bytes: %s',
+                              len(out_buf), packet.HexDump(out_buf))
+
+        command = out_buf[0]
+        estimator = self._estimator(command)
+
+        if command in self.VERIFY_COMMANDS:
+            # verifying encodes another packet into the shared buffer
+            out_buf = bytes(out_buf)
+            max_attempts = self.WRITE_ATTEMPTS
+        elif command in self.UNSAFE_COMMANDS:
+            max_attempts = 1
+        else:
+            max_attempts = self.READ_ATTEMPTS
+
+        start = time.perf_counter()
+        wait = 0.0
+        stale = 0
+        timeouts = 0
+        writes = 0
+        attempt = 0
+        lost = False
+
+        while True:
+            attempt += 1
+            # a write that read back as lost always goes again, even
+            # on transports that otherwise just wait for the reply
+            if attempt == 1 or lost or self.transport.resend_on_retry:
+                self.transport.write(out_buf)
+                writes += 1
+
+            if command in self.UNSAFE_COMMANDS:
+                # never learned from, and nothing to retry anyway
+                timeout = self.transport.default_timeout
             else:
-                raise RuntimeError('bad cmd')
+                timeout = estimator.timeout()
 
-        out_buf = (''.join([chr(x) for x in out_buf])).encode('latin1')
-        if len(out_buf) != 32:
-            raise RuntimeError('Buffer too big!')
+            read_start = time.perf_counter()
+            in_buf, skipped = self._wait_reply(out_buf, timeout)
+            wait += time.perf_counter() - read_start
+            stale += skipped
 
-        self.logger.debug('Send: %d bytes: %s',
-                          len(out_buf),
-                          ' '.join('%02x' % x for x in out_buf))
+            if len(in_buf) != 0:
+                if attempt == 1:
+                    estimator.sample(time.perf_counter() - read_start)
+                break
 
-        if not self.use_hid:
-            result = self.device.write(self.out_ep, out_buf, timeout=1000)
+            timeouts += 1
+            estimator.backoff()
 
-        retry_count = 0
-        while retry_count <= 1:
-            if self.use_hid:
-                result = self.hid_device.write(out_buf)
-                in_buf = self.hid_device.read(32, 300)  # 1s timeout
-            else:
-                in_buf = self.device.read(self.in_ep, 32, timeout=1000)
+            if command in self.VERIFY_COMMANDS:
+                # a second copy of a write is only sent once it's
+                # known the first didn't make it
+                verified = self._verify_write(out_buf)
+                if verified is not None:
+                    in_buf = verified
+                    break
+                lost = True
 
-            if len(in_buf) != 0:
+            if attempt >= max_attempts:
                 break
-            retry_count += 1
-            # self.logger.info(f'Bad read: {len(in_buf)} bytes... retrying...')
 
-        self.logger.debug('Recv: %s bytes: %s',
-                          len(in_buf),
-                          ' '.join('%02x' % x for x in in_buf))
+        elapsed = time.perf_counter() - start
+        self.stats.record(command, len(out_buf) * writes, len(in_buf),
+                          elapsed, timeouts=timeouts,
+                          retries=attempt - 1, stale=stale)
+        self.stats.record_time(elapsed, wait)
+
+        if debug:
+            self.logger.debug('Recv: %s bytes: %s',
+                              len(in_buf), packet.HexDump(in_buf))
+
+        # unsafe commands may legitimately go unanswered (the board
+        # resets); anything else has run out of tries
+        if len(in_buf) == 0 and command not in self.UNSAFE_COMMANDS:
+            raise RuntimeError('No reply for %s' % bytes(out_buf[:4]).hex())
         return in_buf
 
+    def _send_commands(self, commands, callback=None):
+        if self.pipeline <= 1:
+            results = []
+            for command in commands:
+                results.append(self._send_command(*command))
+                if callback is not None:
+                    callback(len(results))
+            return results
+
+        return self._send_pipelined(commands, callback=callback)
+
+    def _send_pipelined(self, commands, callback=None):
+        with self.lock:
+            return self._send_pipelined_locked(commands, callback=callback)
+
+    def _send_pipelined_locked(self, commands, callback=None):
+        # keep up to self.pipeline requests in flight, matching replies
+        # back up by the echoed command/offset header.  Only safe for
+        # idempotent reads, since anything outstanding at a timeout is
+        # sent again.
+        packets = [bytes(self._encode(*command)) for command in commands]
+        results = [None] * len(packets)
+        pending = {}
+        attempts = {}
+        sent_at = {}
+        next_packet = 0
+        done = 0
+        start = time.perf_counter()
+        wait = 0.0
+        estimator = self._estimator(packets[0][0]) if packets else None
+
+        while done < len(packets):
+            while next_packet < len(packets) and \
+                    len(pending) < self.pipeline:
+                out_buf = packets[next_packet]
+                key = bytes(out_buf[:4])
+                if key in pending:
+                    break
+                self.transport.write(out_buf)
+                pending[key] = next_packet
+                attempts[key] = 1
+                sent_at[key] = time.perf_counter()
+                next_packet += 1
+
+            read_start = time.perf_counter()
+            in_buf = self.transport.read(self.report_size,
+                                         estimator.timeout())
+            wait += time.perf_counter() - read_start
+
+            if len(in_buf) == 0:
+                self.logger.debug('Pipeline timeout with %d outstanding',
+                                  len(pending))
+                estimator.backoff()
+                for key, idx in pending.items():
+                    if attempts[key] >= self.READ_ATTEMPTS:
+                        raise RuntimeError('No reply for %s' % key.hex())
+                    attempts[key] += 1
+                    self.transport.write(packets[idx])
+                continue
+
+            key = bytes(in_buf[:4])
+            if key not in pending:
+                # duplicate from a re-send, or late from a timeout
+                self.logger.debug('Discarding stray reply: %s',
+                                  packet.HexDump(in_buf))
+                continue
+
+            idx = pending.pop(key)
+            results[idx] = in_buf
+            done += 1
+
+            # includes time queued behind the rest of the pipeline,
+            # which is what the next read has to allow for anyway
+            if attempts[key] == 1:
+                estimator.sample(time.perf_counter() - sent_at[key])
+
+            self.stats.record(key[0], len(packets[idx]) * attempts[key],
+                              len(in_buf),
+                              time.perf_counter() - sent_at[key],
+                              timeouts=attempts[key] - 1,
+                              retries=attempts[key] - 1)
+
+            if callback is not None:
+                callback(done)
+
+        self.stats.record_time(time.perf_counter() - start, wait)
+
+        return results
+
+    def _probe_protocol(self):
+        # a single try at a fixed timeout, kept out of the retries and
+        # the learned timeouts so one silent path can't slow the next
+        out_buf = self._encode(self.GET_PROTOCOL_VERSION)
+        with self.lock:
+            self.transport.write(out_buf)
+            in_buf, _ = self._wait_reply(out_buf, self.PROBE_TIMEOUT)
+        if len(in_buf) < 3:
+            return None
+        return in_buf[1] * 256 + in_buf[2]
+
     def find_hidpath(self):
         self.logger.info(f'Probing for raw hid device among {self.device}')
         for item in self.device:
-            self.hid_device = hid.Device(path=item)
+            self.set_transport(transport.HidTransport(hid.Device(path=item),
+                                                      path=item))
             try:
-                buf = self._send_command(self.GET_PROTOCOL_VERSION)
-                pver = buf[1] * 256 + buf[2]
-            except Exception:
+                pver = self._probe_protocol()
+            except Exception as e:
+                self.logger.info(f'Error probing {item}: {e}')
+                pver = None
+
+            if pver is None:
                 self.logger.info(f'Timeout for {item}')
-                self.hid_device.close()
+                self.transport.close()
                 continue
 
             if pver not in self.PROTOCOLS:
                 self.logger.info(f'Invalid protocol: {pver}')
             else:
                 self.logger.info(f'Using path {item}')
+                self.hid_path = item
+                self._protocol = pver
                 return
 
         raise RuntimeError('Cannot find suitable hid device')
@@ -400,10 +874,13 @@ class Keyboard(object):
             self.logger.debug('Iface %s', intf.bInterfaceNumber)
 
             ep_addrs = []
+            packet_sizes = []
 
             for ep in intf:
                 ep_addrs.append(ep.bEndpointAddress)
-                self.logger.debug('  %s', ep.bEndpointAddress)
+                packet_sizes.append(ep.wMaxPacketSize)
+                self.logger.debug('  %s (%d bytes)', ep.bEndpointAddress,
+                                  ep.wMaxPacketSize)
 
             if len(ep_addrs) == 2:
                 ep1 = ep_addrs[0]
@@ -412,9 +889,13 @@ class Keyboard(object):
                 self.out_ep = ep1 if ep1 < 0x7f else ep2
                 self.in_ep = ep2 if self.out_ep == ep1 else ep1
                 self.interface = intf.bInterfaceNumber
+                self.max_packet_size = max(min(packet_sizes),
+                                           transport.DEFAULT_REPORT_SIZE)
 
-                self.logger.info('Using interface %d: in %d/out %d',
-                                 self.interface, self.in_ep, self.out_ep)
+                self.logger.info('Using interface %d: in %d/out %d, '
+                                 '%d byte reports', self.interface,
+                                 self.in_ep, self.out_ep,
+                                 self.max_packet_size)
                 break
 
         if not self.interface:
@@ -0,0 +1,194 @@
+import array
+import sys
+
+
+class Keymap(object):
+    # layers x rows x cols keycodes in one flat array('H'), laid out
+    # the same way as the device's DYNAMIC_KEYMAP buffer.  keymap[layer]
+    # [row][col] still works: rows come back as memoryview slices, so
+    # they can be read and assigned without copying.
+    def __init__(self, layers, rows, cols, data=None):
+        self.layers = layers
+        self.rows = rows
+        self.cols = cols
+        self.layer_size = rows * cols
+
+        if data is None:
+            data = array.array('H', bytes(layers * self.layer_size * 2))
+        elif len(data) != layers * self.layer_size:
+            raise RuntimeError('Keymap is %d keys, expected %d' % (
+                len(data), layers * self.layer_size))
+
+        self.data = data
+        self.view = memoryview(data)
+
+        # layers whose contents are actually known
+        self.loaded = set(range(layers))
+
+    @classmethod
+    def empty(cls, layers, rows, cols):
+        keymap = cls(layers, rows, cols)
+        keymap.loaded = set()
+        return keymap
+
+    @classmethod
+    def from_bytes(cls, buffer, layers, rows, cols):
+        # buffer is big endian, straight off the wire
+        data = array.array('H')
+        data.frombytes(bytes(buffer))
+        if sys.byteorder == 'little':
+            data.byteswap()
+        return cls(layers, rows, cols, data)
+
+    @classmethod
+    def from_list(cls, kmap):
+        layers = len(kmap)
+        rows = len(kmap[0])
+        cols = len(kmap[0][0])
+        data = array.array('H', (keycode
+                                 for layer in kmap
+                                 for row in layer
+                                 for keycode in row))
+        return cls(layers, rows, cols, data)
+
+    def tobytes(self):
+        if sys.byteorder == 'little':
+            data = array.array('H', self.data)
+            data.byteswap()
+            return data.tobytes()
+        return self.data.tobytes()
+
+    def tolist(self):
+        return [[self.view[start:start + self.cols].tolist()
+                 for start in range(layer * self.layer_size,
+                                    (layer + 1) * self.layer_size,
+                                    self.cols)]
+                for layer in range(self.layers)]
+
+    def copy(self):
+        keymap = Keymap(self.layers, self.rows, self.cols,
+                        array.array('H', self.data))
+        keymap.loaded = set(self.loaded)
+        return keymap
+
+    def offset(self, layer, row, col):
+        return (layer * self.layer_size) + (row * self.cols) + col
+
+    def get(self, offset):
+        return self.data[offset]
+
+    def set(self, offset, value):
+        self.data[offset] = value
+
+    def layer_view(self, layer):
+        start = layer * self.layer_size
+        return self.view[start:start + self.layer_size]
+
+    def set_layer_bytes(self, layer, buffer):
+        data = array.array('H')
+        data.frombytes(bytes(buffer))
+        if sys.byteorder == 'little':
+            data.byteswap()
+        self.layer_view(layer)[:] = data
+        self.loaded.add(layer)
+
+    def layer_equal(self, other, layer):
+        return self.layer_view(layer) == other.layer_view(layer)
+
+    def layer_diff(self, other, layer):
+        # offsets in this layer that differ from other
+        if self.layer_equal(other, layer):
+            return []
+
+        start = layer * self.layer_size
+        mine = self.layer_view(layer)
+        theirs = other.layer_view(layer)
+        return [start + idx
+                for idx in range(self.layer_size)
+                if mine[idx] != theirs[idx]]
+
+    def has_layer(self, layer):
+        return layer in self.loaded
+
+    def __getitem__(self, layer):
+        if layer < 0 or layer >= self.layers:
+            raise IndexError('layer %d out of range' % layer)
+        return _LayerView(self, layer)
+
+    def __len__(self):
+        return self.layers
+
+    def __iter__(self):
+        for layer in range(self.layers):
+            yield self[layer]
+
+    def __eq__(self, other):
+        if not isinstance(other, Keymap):
+            return NotImplemented
+        return (self.layers, self.rows, self.cols) == \
+            (other.layers, other.rows, other.cols) and \
+            self.data == other.data
+
+
+class _LayerView(object):
+    def __init__(self, keymap, layer):
+        self.keymap = keymap
+        self.start = layer * keymap.layer_size
+
+    def __getitem__(self, row):
+        if row < 0 or row >= self.keymap.rows:
+            raise IndexError('row %d out of range' % row)
+        start = self.start + (row * self.keymap.cols)
+        return self.keymap.view[start:start + self.keymap.cols]
+
+    def __len__(self):
+        return self.keymap.rows
+
+    def __iter__(self):
+        for row in range(self.keymap.rows):
+            yield self[row]
+
+
+class DirtyMap(object):
+    # pending key changes, indexed by the same flat offsets as Keymap:
+    # a flag byte per key plus a parallel array of new keycodes
+    def __init__(self, size):
+        self.size = size
+        self.flags = bytearray(size)
+        self.values = array.array('H', bytes(size * 2))
+        self.count = 0
+
+    def set(self, offset, value):
+        if not self.flags[offset]:
+            self.flags[offset] = 1
+            self.count += 1
+        self.values[offset] = value
+
+    def get(self, offset, default=None):
+        if self.flags[offset]:
+            return self.values[offset]
+        return default
+
+    def is_dirty(self, offset):
+        return self.flags[offset] != 0
+
+    def clear(self):
+        self.flags[:] = bytes(self.size)
+        self.count = 0
+
+    def offsets(self):
+        offset = self.flags.find(1)
+        while offset != -1:
+            yield offset
+            offset = self.flags.find(1, offset + 1)
+
+    def items(self):
+        # (offset, value) in offset order
+        for offset in self.offsets():
+            yield offset, self.values[offset]
+
+    def __len__(self):
+        return self.count
+
+    def __bool__(self):
+        return self.count != 0
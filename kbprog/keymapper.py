@@ -1,240 +1,767 @@
 import json
 import logging
 import os
+import pickle
+import threading
 
-from kbprog import keys
+from kbprog import keys, planner, snapshot
+from kbprog.cache import default_cache_dir
+from kbprog.keymap import DirtyMap, Keymap
+from kbprog.loader import LayerScheduler
+
+
+WIRING_PATH = os.path.join(os.path.dirname(__file__), 'wiring')
+LAYOUT_PATH = os.path.join(os.path.dirname(__file__), 'layouts')
+
+
+def load_wiring(tag, layout=None):
+    wiring_file = os.path.join(WIRING_PATH, '%s.json' % tag)
+
+    if not os.path.exists(wiring_file):
+        raise RuntimeError(
+            'Unknown wiring for %s' % tag)
+
+    with open(wiring_file, 'r') as f:
+        try:
+            wiring = json.loads(f.read())
+        except Exception:
+            print(f'Error loading {wiring_file}')
+            raise
 
+    wirings = wiring['layouts']
 
-class Keymapper(object):
-    def __init__(self, keyboard, layout=None):
-        self.keyboard = keyboard
-        self.logger = logging.getLogger(__name__)
-        self.map = None
-        self.dirtymap = {}
+    logging.getLogger(__name__).debug('Wirings for %s: %s', tag, wirings)
 
-        wiring_path = os.path.join(
-            os.path.dirname(__file__),
-            'wiring')
+    if len(wirings) == 1 and layout is None:
+        layout = list(wirings.keys())[0]
+
+    if layout not in wirings:
+        raise RuntimeError(
+            'missing/invalid layout.  '
+            'valid layouts: %s' % ', '.join(wirings.keys()))
+
+    return layout, wirings[layout]
+
+
+def parse_backup(input_file, wiring, layout_name):
+    # returns the layer count and a list of
+    # (layer, row, col, keycode, keypos) for every wired key, where
+    # row/col are matrix positions and keypos is the index into the
+    # layout's keylist
+    with open(input_file, 'r') as f:
+        lines = f.read().split('\n')
+
+    layout = lines[0]
+    lines = lines[1:]
+
+    if layout != layout_name:
+        # there might be some kind of conversion that could
+        # be attempted
+        raise RuntimeError(
+            f'This layout is for {layout}, not {layout_name}')
+
+    lines = [line.strip()
+             for line in lines
+             if line.strip() != '' and line[0] != '#']
+
+    if len(lines) % len(wiring):
+        raise RuntimeError(
+            '%d key rows is not a whole number of layers of %d rows' % (
+                len(lines), len(wiring)))
+
+    target = []
+    layer = 0
+    row = 0
+    keypos = 0
+    for line in lines:
+        keycodes = [int(x.strip()) for x in line.split(',')]
+        for col, keycode in enumerate(keycodes):
+            map_row, map_col = wiring[row][col]
+            target.append((layer, map_row, map_col, keycode, keypos))
+            keypos += 1
+
+        row += 1
+        if row >= len(wiring):
+            layer += 1
+            row = 0
+            keypos = 0
+
+    return layer, target
+
+
+def write_backup(output_file, layout_name, wiring, kmap, layers,
+                 extras=None):
+    # extras are "#!" lines carrying what the key rows can't (the
+    # protocol, macros, unwired matrix positions); parse_backup skips
+    # them like any other comment
+    with open(output_file, 'w') as f:
+        f.write(f'{layout_name}\n')
+        for line in extras or []:
+            f.write(f'#! {line}\n')
+
+        for layer in range(layers):
+            f.write(f'#\n# LAYER {layer}\n#\n')
+
+            for row in wiring:
+                label_vals = []
+                key_vals = []
+
+                for col in row:
+                    row_idx, col_idx = col
+                    key = kmap[layer][row_idx][col_idx]
+                    key_vals.append(key)
+                    label_vals.append(keys.label_for_keycode(key))
+
+                f.write('# ' + ', '.join(
+                    f'{l:>7}' for l in label_vals) + '\n')
+                f.write('  ' + ', '.join(
+                    f'{str(k):>7}' for k in key_vals) + '\n')
+
+
+def macro_extras(macros):
+    # escaped the same way "macro" takes them on the command line
+    return ['macro %d %s' % (idx, macro.encode('unicode_escape').decode(
+        'ascii')) for idx, macro in enumerate(macros)]
+
+
+def parse_backup_extras(input_file):
+    extras = {'protocol': 0, 'macros': None, 'matrix': []}
+
+    with open(input_file, 'r') as f:
+        for line in f:
+            if not line.startswith('#! '):
+                continue
+            kind, _, rest = line[3:].rstrip('\n').partition(' ')
+            if kind == 'protocol':
+                extras['protocol'] = int(rest)
+            elif kind == 'macro':
+                index, _, value = rest.partition(' ')
+                macros = extras['macros'] or []
+                while len(macros) <= int(index):
+                    macros.append('')
+                macros[int(index)] = bytes(value, 'latin1').decode(
+                    'unicode_escape')
+                extras['macros'] = macros
+            elif kind == 'matrix':
+                extras['matrix'].append(tuple(int(x) for x in rest.split()))
+
+    return extras
+
+
+def load_target(input_file, tag, layout=None):
+    # (layout, layers, target) as parse_backup returns them, from
+    # either a text backup or a snapshot
+    if not snapshot.is_snapshot(input_file):
+        layout, wiring = load_wiring(tag, layout)
+        layers, target = parse_backup(input_file, wiring, layout)
+        return layout, layers, target
+
+    with snapshot.load(input_file) as snap:
+        if snap.tag != tag:
+            raise RuntimeError(
+                f'This snapshot is for {snap.tag}, not {tag}')
+        layout, wiring = load_wiring(tag, layout or snap.layout)
+        kmap = snap.keymap()
 
-        layout_path = os.path.join(
-            os.path.dirname(__file__),
-            'layouts')
+    target = []
+    for layer in range(kmap.layers):
+        keypos = 0
+        for row in wiring:
+            for map_row, map_col in row:
+                target.append((layer, map_row, map_col,
+                               kmap[layer][map_row][map_col], keypos))
+                keypos += 1
 
-        wiring_file = os.path.join(
-            wiring_path, '%s.json' % keyboard.tag)
+    return layout, kmap.layers, target
+
+
+def snapshot_to_text(input_file, output_file):
+    with snapshot.load(input_file) as snap:
+        layout_name, wiring = load_wiring(snap.tag, snap.layout)
+        kmap = snap.keymap()
+        macros = snap.macros()
+        protocol = snap.protocol
+
+    wired = set()
+    for row in wiring:
+        wired.update((map_row, map_col) for map_row, map_col in row)
+
+    extras = ['protocol %d' % protocol]
+    if macros is not None:
+        extras += macro_extras(macros)
+    for layer in range(kmap.layers):
+        for row in range(kmap.rows):
+            for col in range(kmap.cols):
+                value = kmap[layer][row][col]
+                if value and (row, col) not in wired:
+                    extras.append('matrix %d %d %d %d' % (
+                        layer, row, col, value))
+
+    write_backup(output_file, layout_name, wiring, kmap, kmap.layers,
+                 extras)
+
+
+def text_to_snapshot(input_file, output_file, tag, rows, cols):
+    with open(input_file, 'r') as f:
+        layout = f.readline().rstrip('\n')
+
+    layout_name, wiring = load_wiring(tag, layout)
+    layers, target = parse_backup(input_file, wiring, layout_name)
+    extras = parse_backup_extras(input_file)
+
+    kmap = Keymap(layers, rows, cols)
+    for layer, map_row, map_col, keycode, _ in target:
+        kmap.set(kmap.offset(layer, map_row, map_col), keycode)
+    for layer, row, col, keycode in extras['matrix']:
+        kmap.set(kmap.offset(layer, row, col), keycode)
+
+    snapshot.Snapshot.from_keymap(tag, layout_name, extras['protocol'],
+                                  kmap, extras['macros']).write(output_file)
+
+
+# bump when compile_geometry() output changes shape
+GEOMETRY_VERSION = 1
+
+# (tag, layout, cols) -> compiled geometry, shared by every Keymapper
+# in the process
+_geometry_memo = {}
+_geometry_lock = threading.Lock()
+
+
+def compile_geometry(tag, layout, cols):
+    layout_name, wiring = load_wiring(tag, layout)
+
+    layout_file = os.path.join(
+        LAYOUT_PATH, '%s.json' % layout_name)
+
+    with open(layout_file, 'r') as f:
+        kle_layout = json.loads(f.read())
+
+    keylist = []
+
+    max_x = 0
+    ypos = 0
+    rownum = 0
+
+    for row in kle_layout:
+        xpos = 0
+        next_w = 1
+        next_h = 1
+        col = 0
+
+        for item in row:
+            if isinstance(item, dict):
+                if 'w' in item:
+                    next_w = item['w']
+                if 'x' in item:
+                    xpos += item['x']
+                if 'y' in item:
+                    ypos += item['y']
+                if 'h' in item:
+                    next_h = item['h']
+            else:
+                w = next_w
+                h = next_h
+                labels = item.split('\n')
+                if len(labels) == 1:
+                    label = labels[0]
+                    shift_label = ''
+                else:
+                    label = labels[1]
+                    shift_label = labels[0]
 
-        if not os.path.exists(wiring_file):
-            raise RuntimeError(
-                'Unknown wiring for %s' % keyboard.tag)
+                map_row, map_col = wiring[rownum][col]
+
+                keyinfo = {'x': xpos,
+                           'y': ypos,
+                           'wiremap': wiring[rownum][col],
+                           # offset within a layer of the flat map
+                           'offset': map_row * cols + map_col,
+                           'label': label,
+                           'shift_label': shift_label,
+                           'w': w,
+                           'h': h}
+
+                keyinfo['found'] = False
+
+                keylist.append(keyinfo)
+
+                if xpos + w > max_x:
+                    max_x = xpos + w
+
+                xpos += next_w
+                next_w = 1
+                col += 1
+
+        ypos += 1
+        rownum += 1
+
+    return {'version': GEOMETRY_VERSION,
+            'sources': _geometry_sources(tag, layout_name),
+            'layout_name': layout_name,
+            'wiring': wiring,
+            'layout': kle_layout,
+            'keylist': keylist,
+            'max_x': max_x,
+            'max_y': ypos}
+
+
+def _geometry_sources(tag, layout_name):
+    # source files and their mtimes, to tell when a compiled
+    # geometry is stale
+    sources = {}
+    for path in (os.path.join(WIRING_PATH, '%s.json' % tag),
+                 os.path.join(LAYOUT_PATH, '%s.json' % layout_name)):
+        sources[path] = os.stat(path).st_mtime
+    return sources
 
-        with open(wiring_file, 'r') as f:
+
+def _geometry_is_current(geometry):
+    if geometry.get('version') != GEOMETRY_VERSION:
+        return False
+
+    for path, mtime in geometry['sources'].items():
+        try:
+            if os.stat(path).st_mtime != mtime:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+def load_geometry(tag, layout, cols):
+    key = (tag, layout, cols)
+
+    with _geometry_lock:
+        if key in _geometry_memo:
+            return _geometry_memo[key]
+
+        geometry_file = os.path.join(
+            default_cache_dir(),
+            'geometry-%s-%s-%d.pickle' % (tag, layout or 'default', cols))
+
+        geometry = None
+        try:
+            with open(geometry_file, 'rb') as f:
+                geometry = pickle.load(f)
+        except Exception:
+            pass
+
+        if geometry is None or not _geometry_is_current(geometry):
+            geometry = compile_geometry(tag, layout, cols)
             try:
-                wiring = json.loads(f.read())
-            except Exception:
-                print(f'Error loading {wiring_file}')
-                raise
+                os.makedirs(os.path.dirname(geometry_file), exist_ok=True)
+                tmp_file = '%s.%d.tmp' % (geometry_file, os.getpid())
+                with open(tmp_file, 'wb') as f:
+                    pickle.dump(geometry, f, pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_file, geometry_file)
+            except OSError as e:
+                logging.getLogger(__name__).debug(
+                    'Could not save geometry to %s: %s',
+                    geometry_file, str(e))
 
-        wirings = wiring['layouts']
+        _geometry_memo[key] = geometry
+        return geometry
 
-        print(wirings)
 
-        if len(wirings) == 1 and layout is None:
-            layout = list(wirings.keys())[0]
+class Keymapper(object):
+    # rounds of rewriting keys that read back wrong, with verify
+    VERIFY_RETRIES = 2
 
-        if layout not in wirings:
-            raise RuntimeError(
-                'missing/invalid layout.  '
-                'valid layouts: %s' % ', '.join(wirings.keys()))
+    def __init__(self, keyboard, layout=None, cache=None):
+        self.keyboard = keyboard
+        self.cache = cache
+        self.logger = logging.getLogger(__name__)
+        self.map = None
+        self.dirtymap = DirtyMap(
+            self.layers * keyboard.rows * keyboard.cols)
 
-        self.layout_name = layout
-        self.wiring = wirings[layout]
+        # offsets of keys whose device value differed from the cached
+        # snapshot
+        self.changed = set()
 
-        layout_file = os.path.join(
-            layout_path, '%s.json' % layout)
+        # macros from a restored file, for program_macros()
+        self.macros = None
 
-        with open(layout_file, 'r') as f:
-            self.layout = json.loads(f.read())
+        # layers that have been read from the device
+        self.loaded = set()
 
-        self.keylist = []
+        geometry = load_geometry(keyboard.tag, layout, keyboard.cols)
+
+        self.layout_name = geometry['layout_name']
+        self.wiring = geometry['wiring']
+        self.layout = geometry['layout']
         self.rows = len(self.layout)
+        self.max_x = geometry['max_x']
+        self.max_y = geometry['max_y']
 
-        max_x = 0
-        ypos = 0
-        rownum = 0
-
-        for row in self.layout:
-            xpos = 0
-            next_w = 1
-            next_h = 1
-            col = 0
-
-            for item in row:
-                if isinstance(item, dict):
-                    if 'w' in item:
-                        next_w = item['w']
-                    if 'x' in item:
-                        xpos += item['x']
-                    if 'y' in item:
-                        ypos += item['y']
-                    if 'h' in item:
-                        next_h = item['h']
-                else:
-                    w = next_w
-                    h = next_h
-                    labels = item.split('\n')
-                    if len(labels) == 1:
-                        label = labels[0]
-                        shift_label = ''
-                    else:
-                        label = labels[1]
-                        shift_label = labels[0]
-
-                    keyinfo = {'x': xpos,
-                               'y': ypos,
-                               'wiremap': self.wiring[rownum][col],
-                               'label': self.label_for(label),
-                               'shift_label': self.label_for(shift_label),
-                               'w': w,
-                               'h': h}
-
-                    keyinfo['found'] = False
-
-                    self.keylist.append(keyinfo)
-
-                    if xpos + w > max_x:
-                        max_x = xpos + w
-
-                    xpos += next_w
-                    next_w = 1
-                    col += 1
-
-            ypos += 1
-            rownum += 1
-
-        self.max_x = max_x
-        self.max_y = ypos
-
-    def program(self, callback=None):
-        total_items = len(self.dirtymap)
+        # the editor hangs its own state off each key, so every
+        # Keymapper gets its own copies
+        self.keylist = []
+        for keyinfo in geometry['keylist']:
+            keyinfo = dict(keyinfo)
+            keyinfo['label'] = self.label_for(keyinfo['label'])
+            keyinfo['shift_label'] = self.label_for(keyinfo['shift_label'])
+            self.keylist.append(keyinfo)
+
+    def key_offset(self, layer, row, col):
+        kb = self.keyboard
+        return (layer * kb.rows * kb.cols) + (row * kb.cols) + col
+
+    def offset_to_key(self, offset):
+        kb = self.keyboard
+        layer, rest = divmod(offset, kb.rows * kb.cols)
+        row, col = divmod(rest, kb.cols)
+        return layer, row, col
+
+    def _dirty_offsets(self, force=False):
+        # offset-sorted (offset, value) pairs, skipping anything that
+        # already matches what's on the board unless forced
+        if force:
+            return list(self.dirtymap.items())
+
+        return [(offset, value)
+                for offset, value in self.dirtymap.items()
+                if self.map.get(offset) != value]
+
+    def plan(self, force=False):
+        # how program() would write the pending changes
+        return planner.plan(self.keyboard, self.map,
+                            self._dirty_offsets(force=force))
+
+    def _write(self, plan, callback=None):
+        total_items = len(plan.writes)
         programmed = 0
 
-        for item, value in self.dirtymap.items():
-            layer, row, col = map(int, item.split(':'))
-            self.keyboard.set_key(layer, row, col, value)
-            self.map[layer][row][col] = value
+        for offset, values in plan.writes:
+            if plan.per_key:
+                layer, row, col = self.offset_to_key(offset)
+                self.keyboard.set_key(layer, row, col, values[0])
+            else:
+                data = bytearray()
+                for value in values:
+                    data += bytearray([(value & 0xFF00) >> 8, value & 0xFF])
+                self.keyboard.set_buffer(offset * 2, data)
+
+            for idx, value in enumerate(values):
+                self.map.set(offset + idx, value)
+
             programmed += 1
             if callback:
                 percent = programmed / total_items
                 callback(percent)
 
-        self.dirtymap = {}
+    def _verify_ranges(self, writes):
+        # byte ranges covering the written runs, merging neighbours
+        # whenever that doesn't take more GET_BUFFER reads.  Alpha
+        # boards read key by key, so there's nothing to gain there.
+        chunk = self.keyboard.chunk_size
+
+        def reads(size):
+            return (size + chunk - 1) // chunk
+
+        ranges = []
+        for offset, values in writes:
+            start = offset * 2
+            size = len(values) * 2
+            if ranges and self.keyboard.supports('keymap_buffer'):
+                last_start, last_size = ranges[-1]
+                merged = start + size - last_start
+                if reads(merged) <= reads(last_size) + reads(size):
+                    ranges[-1] = (last_start, merged)
+                    continue
+            ranges.append((start, size))
+
+        return ranges
+
+    def verify(self, writes):
+        # read back what was written; (offset, expected, actual) for
+        # every key written that doesn't hold what it should
+        ranges = self._verify_ranges(writes)
+        buffers = self.keyboard.read_keymap(ranges)
+
+        written = set()
+        for offset, values in writes:
+            written.update(range(offset, offset + len(values)))
+
+        mismatched = []
+        for (start, size), buffer in zip(ranges, buffers):
+            for idx in range(size // 2):
+                offset = (start // 2) + idx
+                if offset not in written:
+                    continue
+                value = (buffer[idx * 2] << 8) | buffer[idx * 2 + 1]
+                if value != self.map.get(offset):
+                    mismatched.append((offset, self.map.get(offset), value))
+
+        self.logger.info('Verified %d writes with %d reads: %d keys wrong',
+                         len(writes), len(ranges), len(mismatched))
+        return mismatched
+
+    def program(self, callback=None, force=False, verify=False):
+        plan = self.plan(force=force)
+
+        self.logger.info('Programming %s', plan.describe())
+
+        self._write(plan, callback=callback)
+        changed_keys = plan.keys
+        total_writes = plan.commands
+
+        attempts = 0
+        while verify and plan.writes:
+            mismatched = self.verify(plan.writes)
+            if not mismatched:
+                break
+
+            attempts += 1
+            if attempts > self.VERIFY_RETRIES:
+                # leave the map as read and the failures pending
+                self.dirtymap.clear()
+                for offset, expected, actual in mismatched:
+                    self.map.set(offset, actual)
+                    self.dirtymap.set(offset, expected)
+                self.save_cache()
+                raise RuntimeError('%d keys still wrong after %d retries' % (
+                    len(mismatched), self.VERIFY_RETRIES))
+
+            # only the keys that didn't take get written again
+            plan = planner.plan(self.keyboard, self.map,
+                                [(offset, expected)
+                                 for offset, expected, _ in mismatched])
+            self.logger.warning('Rewriting %s', plan.describe())
+            self._write(plan)
+            total_writes += plan.commands
+
+        self.dirtymap.clear()
+        self.save_cache()
+
+        return changed_keys, total_writes
 
     def restore(self, input_file):
-        with open(input_file, 'r') as f:
-            lines = f.read().split('\n')
+        if snapshot.is_snapshot(input_file):
+            self.restore_snapshot(input_file)
+        else:
+            layers, target = parse_backup(input_file, self.wiring,
+                                          self.layout_name)
 
-        layout = lines[0]
-        lines = lines[1:]
+            if layers != self.layers:
+                raise RuntimeError('Backup has %d layers, board has %d' % (
+                    layers, self.layers))
 
-        if layout != self.layout_name:
-            # there might be some kind of conversion that could
-            # be attempted
-            raise RuntimeError(
-                f'This layout is for {layout}, not {self.layout_name}')
+            self.apply_target(target, verbose=True)
+            self.macros = parse_backup_extras(input_file)['macros']
 
-        lines = [line.strip()
-                 for line in lines
-                 if line.strip() != '' and line[0] != '#']
+        print(f'{len(self.dirtymap)} items changed')
 
-        if len(lines) != len(self.wiring) * self.layers:
-            raise RuntimeError(f'Wrong number of rows/layers')
+    def restore_snapshot(self, input_file):
+        # the snapshot is the board's whole keymap buffer, so it's
+        # compared as is, without going through the wiring
+        kb = self.keyboard
+        with snapshot.load(input_file) as snap:
+            if snap.tag != kb.tag:
+                raise RuntimeError(
+                    f'This snapshot is for {snap.tag}, not {kb.tag}')
+            if (snap.layers, snap.rows, snap.cols) != \
+                    (self.layers, kb.rows, kb.cols):
+                raise RuntimeError(
+                    'Snapshot is %d layers of %dx%d, board is %d of %dx%d' % (
+                        snap.layers, snap.rows, snap.cols,
+                        self.layers, kb.rows, kb.cols))
+
+            self.apply_map(snap.keymap(), verbose=True)
+            self.macros = snap.macros()
+
+    def program_macros(self):
+        # macros that came with the restored file, if any
+        kb = self.keyboard
+        if self.macros is None or not kb.macro_count:
+            return 0
+
+        if len(self.macros) > kb.macro_count:
+            self.logger.warning('Board holds %d macros, dropping %d',
+                                kb.macro_count,
+                                len(self.macros) - kb.macro_count)
+        for index, value in enumerate(self.macros[:kb.macro_count]):
+            kb.macros[index] = value
+        return kb.save_macros()
+
+    def assume_map(self, value=0):
+        # stand-in for get_map() when the board's contents don't
+        # matter, e.g. when everything is about to be overwritten
+        kb = self.keyboard
+        self.map = Keymap(self.layers, kb.rows, kb.cols)
+        if value:
+            for offset in range(len(self.map.data)):
+                self.map.set(offset, value)
+        self.loaded = set(range(self.layers))
+
+        # none of it was read, so the planner mustn't pad writes with
+        # it, or unwired positions the file never mentions get
+        # overwritten
+        self.map.loaded = set()
+
+    def apply_target(self, target, verbose=False, force=False):
+        # mark every key in a parsed backup that differs from the
+        # current map (or every key at all, if forced) as dirty.  The
+        # backup goes into a copy of the map, which is then compared
+        # with the current one a layer at a time.
+        wanted = self.map.copy()
+        offsets = []
+        for layer, map_row, map_col, keycode, keypos in target:
+            offset = self.key_offset(layer, map_row, map_col)
+            wanted.set(offset, keycode)
+            offsets.append(offset)
+
+        self.apply_map(wanted, verbose=verbose,
+                       force=sorted(offsets) if force else None)
+
+    def apply_map(self, wanted, verbose=False, force=None):
+        # force is a list of offsets to mark whether they differ or not
+        if force is not None:
+            changed = force
+        else:
+            changed = []
+            for layer in range(self.layers):
+                changed += wanted.layer_diff(self.map, layer)
+
+        for offset in changed:
+            self.dirtymap.set(offset, wanted.get(offset))
+
+        if verbose and self.logger.isEnabledFor(logging.DEBUG):
+            labels = {keyinfo['offset']: keyinfo.get('label', 'unknown')
+                      for keyinfo in self.keylist}
+            layer_size = self.keyboard.rows * self.keyboard.cols
+            for offset in changed:
+                layer, map_row, map_col = self.offset_to_key(offset)
+                old_keycode = self.map.get(offset)
+                keycode = wanted.get(offset)
+                idx = f'{layer}:{map_row}:{map_col}'
+                old_key = keys.bytes_to_key.get(old_keycode, old_keycode)
+                new_key = keys.bytes_to_key.get(keycode, keycode)
+                keylabel = labels.get(offset % layer_size, 'unwired')
+
+                self.logger.debug(f'{idx} ({keylabel}) was {old_key}, updating to {new_key}')
+
+    def backup(self, output_file, macros=False):
+        # a snapshot if the name says so, otherwise the text format
+        kb = self.keyboard
+        macros = kb.macros[:kb.macro_count] if macros else None
+
+        if output_file.endswith(snapshot.SUFFIX):
+            snapshot.Snapshot.from_keymap(
+                kb.tag, self.layout_name, kb.protocol, self.map,
+                macros).write(output_file)
+            return
+
+        write_backup(output_file, self.layout_name, self.wiring, self.map,
+                     self.layers,
+                     macro_extras(macros) if macros is not None else None)
+
+    def _keyinfo_offset(self, layer, keyinfo):
+        kb = self.keyboard
+        return layer * kb.rows * kb.cols + keyinfo['offset']
 
-        layer = 0
-        row = 0
-        keypos = 0
-        for line in lines:
-            keycodes = [int(x.strip()) for x in line.split(',')]
-            for col, keycode in enumerate(keycodes):
-                map_row, map_col = self.wiring[row][col]
-                old_keycode = self.map[layer][map_row][map_col]
-                if keycode != old_keycode:
-                    idx = f'{layer}:{map_row}:{map_col}'
-                    self.dirtymap[idx] = keycode
-                    old_key = keys.bytes_to_key.get(old_keycode, old_keycode)
-                    new_key = keys.bytes_to_key.get(keycode, keycode)
-                    keylabel = self.keylist[keypos].get('label', 'unknown')
-
-                    self.logger.info(f'{idx} ({keylabel}) was {old_key}, updating to {new_key}')
-                keypos += 1
+    def is_dirty(self, layer, keyinfo):
+        return self.dirtymap.is_dirty(self._keyinfo_offset(layer, keyinfo))
 
-            row += 1
-            if row >= len(self.wiring):
-                layer += 1
-                row = 0
-                keypos = 0
+    def set_key(self, layer, keyinfo, newcode):
+        self.dirtymap.set(self._keyinfo_offset(layer, keyinfo),
+                          keys.key_to_bytes[newcode])
 
-        assert row == 0
-        assert layer == self.layers
+    def label_for_key(self, layer, keyinfo):
+        if self.map is None or not self.map.has_layer(layer):
+            return '?'
 
-        print(f'{len(self.dirtymap)} items changed')
+        offset = self._keyinfo_offset(layer, keyinfo)
+        key = self.dirtymap.get(offset)
+        if key is None:
+            key = self.map.get(offset)
 
+        label = keys.label_for_keycode(key)
+        return label
 
-    def backup(self, output_file):
-        with open(output_file, 'w') as f:
-            f.write(f'{self.layout_name}\n')
-            for layer in range(self.layers):
-                f.write(f'#\n# LAYER {layer}\n#\n')
+    def label_for(self, what):
+        return what
 
-                for row in self.wiring:
-                    label_vals = []
-                    key_vals = []
+    def get_map(self, callback=None, layer_callback=None, scheduler=None):
+        # reads a layer at a time, in the order the scheduler hands
+        # them out, so callers can use each layer as it arrives.
+        # Anything already in self.map (say, from the cache) stays
+        # visible until its layer is replaced, and keys that differ
+        # from it are noted in self.changed.
+        if scheduler is None:
+            scheduler = LayerScheduler(self.layers)
+
+        kb = self.keyboard
+        old_map = self.map
+        if self.map is None:
+            self.map = Keymap.empty(self.layers, kb.rows, kb.cols)
+        else:
+            self.map = self.map.copy()
 
-                    for col in row:
-                        row_idx, col_idx = col
-                        key = self.map[layer][row_idx][col_idx]
-                        key_vals.append(key)
-                        label_vals.append(keys.label_for_keycode(key))
+        self.loaded = set()
+        self.changed = set()
 
-                    f.write('# ' + ', '.join(
-                        f'{l:>7}' for l in label_vals) + '\n')
-                    f.write('  ' + ', '.join(
-                        f'{str(k):>7}' for k in key_vals) + '\n')
+        while True:
+            layer = scheduler.next()
+            if layer is None:
+                break
 
-    def is_dirty(self, layer, keyinfo):
-        row, col = keyinfo['wiremap']
-        idx = '%s:%s:%s' % (layer, row, col)
+            def progress(percent, done=len(self.loaded)):
+                if callback is not None:
+                    callback((done + percent) / self.layers)
 
-        if idx in self.dirtymap:
-            return True
+            buffer = kb.read_keymap([kb.layer_range(layer)],
+                                    callback=progress)[0]
+            new_map = self.map.copy()
+            new_map.set_layer_bytes(layer, buffer)
 
-        return False
+            if old_map is not None and old_map.has_layer(layer):
+                self.changed.update(new_map.layer_diff(old_map, layer))
 
-    def set_key(self, layer, keyinfo, newcode):
-        row, col = keyinfo['wiremap']
-        idx = '%s:%s:%s' % (layer, row, col)
-        self.dirtymap[idx] = keys.key_to_bytes[newcode]
+            # swap in a whole new map so the UI never sees a layer
+            # half written
+            self.map = new_map
+            self.loaded.add(layer)
 
-    def label_for_key(self, layer, keyinfo):
-        if self.map is None:
-            return '?'
+            if layer_callback is not None:
+                layer_callback(layer)
 
-        row, col = keyinfo['wiremap']
+        if self.changed:
+            self.logger.info('%d keys changed since cached snapshot',
+                             len(self.changed))
 
-        idx = '%s:%s:%s' % (layer, row, col)
+        self.save_cache()
 
-        if idx in self.dirtymap:
-            key = self.dirtymap[idx]
-        else:
-            key = self.map[layer][row][col]
+    def load_cached_map(self):
+        if self.cache is None:
+            return False
 
-        label = keys.label_for_keycode(key)
-        return label
+        kb = self.keyboard
+        entry = self.cache.load(kb.identity)
+        if entry is None:
+            return False
 
-    def label_for(self, what):
-        return what
+        if (entry['protocol'], entry['layers']) != (kb.protocol, kb.layers):
+            self.logger.info('Ignoring cached map: was protocol %s with %s '
+                             'layers, now %s with %s', entry['protocol'],
+                             entry['layers'], kb.protocol, kb.layers)
+            return False
+
+        self.map = Keymap.from_list(entry['map'])
+        return True
+
+    def save_cache(self):
+        kb = self.keyboard
+        if self.cache is not None and self.map is not None:
+            self.cache.save(kb.identity, self.map.tolist(), kb.protocol,
+                            kb.layers, kb.report_size)
+
+    def is_loaded(self, layer):
+        return layer in self.loaded
 
-    def get_map(self, callback=None):
-        self.map = self.keyboard.keyboard_map(callback=callback)
+    def is_changed(self, layer, keyinfo):
+        return self._keyinfo_offset(layer, keyinfo) in self.changed
 
     @property
     def layers(self):
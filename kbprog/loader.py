@@ -0,0 +1,26 @@
+import threading
+
+
+class LayerScheduler(object):
+    # hands out layers to read, most wanted first.  The editor bumps
+    # a layer to the front when its tab is clicked.
+    def __init__(self, layers, first=0):
+        self.lock = threading.Lock()
+        self.pending = list(range(layers))
+        self.prioritize(first)
+
+    def prioritize(self, layer):
+        with self.lock:
+            if layer in self.pending:
+                self.pending.remove(layer)
+                self.pending.insert(0, layer)
+
+    def next(self):
+        with self.lock:
+            if not self.pending:
+                return None
+            return self.pending.pop(0)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.pending)
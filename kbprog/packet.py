@@ -0,0 +1,62 @@
+import struct
+
+
+class HexDump(object):
+    # formats only when a log record is actually emitted
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return ' '.join('%02x' % x for x in self.data)
+
+
+class PacketCodec(object):
+    OFFSET_HEADER = struct.Struct('>BHB')
+
+    def __init__(self, size=32):
+        self.size = size
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.zeros = bytes(size)
+
+    def encode(self, *args):
+        # the returned buffer is reused by the next encode, so anything
+        # that needs to hold on to a packet has to copy it
+        view = self.view
+        view[:] = self.zeros
+        ofs = 0
+
+        for item in args:
+            if isinstance(item, int):
+                view[ofs] = item
+                ofs += 1
+                continue
+
+            if isinstance(item, str):
+                item = item.encode('latin1')
+            elif not isinstance(item, (bytes, bytearray, memoryview)):
+                raise RuntimeError('bad cmd')
+
+            end = ofs + len(item)
+            if end > self.size:
+                raise RuntimeError('Buffer too big!')
+            view[ofs:end] = item
+            ofs = end
+
+        return self.buffer
+
+    def encode_offset(self, command, offset, size, data=None):
+        view = self.view
+        view[:] = self.zeros
+        self.OFFSET_HEADER.pack_into(self.buffer, 0, command, offset, size)
+
+        if data is not None:
+            end = self.OFFSET_HEADER.size + len(data)
+            if end > self.size:
+                raise RuntimeError('Buffer too big!')
+            view[self.OFFSET_HEADER.size:end] = data
+
+        return self.buffer
+
+    def decode_offset(self, packet):
+        return self.OFFSET_HEADER.unpack_from(packet, 0)
@@ -0,0 +1,127 @@
+from kbprog.keyboard import Keyboard
+
+# seconds per round trip when nothing has been measured yet; about
+# what a full speed raw hid board with a 1ms poll interval manages
+DEFAULT_RTT = 0.002
+
+
+def estimate_rtt(keyboard, command):
+    # nothing has usually been written yet when a plan is made, so
+    # fall back to the matching read (GET_KEYCODE for SET_KEYCODE and
+    # so on), then to whatever this board has answered most often: a
+    # round trip costs much the same whatever the command
+    candidates = [keyboard.rtt.get(command),
+                  keyboard.rtt.get(Keyboard.VERIFY_COMMANDS.get(command))]
+    candidates += sorted(keyboard.rtt.values(),
+                         key=lambda estimator: -estimator.samples)
+
+    for estimator in candidates:
+        if estimator is not None and estimator.srtt is not None:
+            return estimator.srtt / 1000.0
+    return DEFAULT_RTT
+
+
+class Plan(object):
+    # writes are (offset, [values]) in key offsets; each is one
+    # command, SET_KEYCODE for a single key or SET_BUFFER for a run
+    def __init__(self, strategy, command, writes, keys, rtt):
+        self.strategy = strategy
+        self.command = command
+        self.writes = writes
+        self.keys = keys
+        self.rtt = rtt
+        self.keys_written = sum(len(values) for _, values in writes)
+        self.alternatives = []
+
+    @property
+    def commands(self):
+        return len(self.writes)
+
+    @property
+    def seconds(self):
+        return self.commands * self.rtt
+
+    @property
+    def per_key(self):
+        return self.command == Keyboard.DYNAMIC_KEYMAP_SET_KEYCODE
+
+    def describe(self):
+        return '%s: %d %s commands for %d keys, ~%.3fs' % (
+            self.strategy, self.commands,
+            Keyboard.COMMAND_NAMES[self.command], self.keys, self.seconds)
+
+
+def per_key_writes(changes):
+    return [(offset, [value]) for offset, value in changes]
+
+
+def _known(current, start, end):
+    # whether current holds what's really on the board from start to
+    # end, i.e. every layer in between was read
+    if end <= start:
+        return True
+    return all(layer in current.loaded
+               for layer in range(start // current.layer_size,
+                                  (end - 1) // current.layer_size + 1))
+
+
+def coalesced_writes(changes, current, max_keys):
+    # merge changes into runs that fit in a single SET_BUFFER
+    # report.  Gaps inside a run are filled with the current
+    # value, which costs bytes but not round trips; where that
+    # isn't known, the run ends instead.
+    runs = []
+
+    for offset, value in changes:
+        if runs and offset - runs[-1][0] < max_keys and \
+                _known(current, runs[-1][0] + len(runs[-1][1]), offset):
+            start, values = runs[-1]
+            while start + len(values) < offset:
+                values.append(current.get(start + len(values)))
+            values.append(value)
+        else:
+            runs.append((offset, [value]))
+
+    return runs
+
+
+def full_writes(changes, current, max_keys):
+    # the whole map, start to end, with changes applied
+    target = current.copy()
+    for offset, value in changes:
+        target.set(offset, value)
+
+    size = len(target.data)
+    return [(start, target.data[start:min(start + max_keys, size)].tolist())
+            for start in range(0, size, max_keys)]
+
+
+def plan(keyboard, current, changes):
+    # cheapest way to get changes (offset-sorted (offset, value)
+    # pairs) onto the board, by round trips times measured RTT.
+    # Ties go to whatever writes fewer keys.
+    key_rtt = estimate_rtt(keyboard, Keyboard.DYNAMIC_KEYMAP_SET_KEYCODE)
+    candidates = [Plan('per-key', Keyboard.DYNAMIC_KEYMAP_SET_KEYCODE,
+                       per_key_writes(changes), len(changes), key_rtt)]
+
+    if keyboard.supports('keymap_buffer') and changes:
+        max_keys = keyboard.chunk_size // 2
+        buffer_rtt = estimate_rtt(keyboard,
+                                  Keyboard.DYNAMIC_KEYMAP_SET_BUFFER)
+        candidates.append(Plan(
+            'coalesced', Keyboard.DYNAMIC_KEYMAP_SET_BUFFER,
+            coalesced_writes(changes, current, max_keys),
+            len(changes), buffer_rtt))
+
+        # needs every layer's current contents to fill in around
+        # the changes
+        if len(current.loaded) == current.layers:
+            candidates.append(Plan(
+                'full', Keyboard.DYNAMIC_KEYMAP_SET_BUFFER,
+                full_writes(changes, current, max_keys),
+                len(changes), buffer_rtt))
+
+    best = min(candidates,
+               key=lambda plan: (plan.seconds, plan.keys_written))
+    best.alternatives = [plan for plan in candidates if plan is not best]
+    return best
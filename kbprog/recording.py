@@ -0,0 +1,159 @@
+import json
+import logging
+import os
+import struct
+import time
+
+from kbprog import transport
+
+
+logger = logging.getLogger(__name__)
+
+# file layout: MAGIC, a '>I' length and that many bytes of JSON header
+# (the board's discover info plus transport settings), then one EVENT
+# per write or read, each followed by its payload.  A read that timed
+# out is stored with no payload.
+MAGIC = b'KBREC\x01'
+HEADER_LENGTH = struct.Struct('>I')
+# kind, microseconds since the previous event, payload length
+EVENT = struct.Struct('>BIH')
+
+WRITE = 0
+READ = 1
+
+
+def kbinfo_header(kbinfo, inner):
+    header = {key: value for key, value in kbinfo.items()
+              if key not in ('device', 'emulated')}
+    header['resend_on_retry'] = inner.resend_on_retry
+    header['default_timeout'] = inner.default_timeout
+    header['report_size'] = inner.report_size
+    return header
+
+
+class RecordingTransport(transport.Transport):
+    # passes everything through to another transport, logging the
+    # report stream to a file as it goes
+    def __init__(self, inner, path, header):
+        self.inner = inner
+        self.path = path
+        self.resend_on_retry = inner.resend_on_retry
+        self.default_timeout = inner.default_timeout
+        self.report_size = inner.report_size
+        self.events = 0
+
+        self.file = open(path, 'wb')
+        header = json.dumps(header, sort_keys=True).encode('utf-8')
+        self.file.write(MAGIC)
+        self.file.write(HEADER_LENGTH.pack(len(header)))
+        self.file.write(header)
+        self.last = time.perf_counter()
+
+    def _event(self, kind, data):
+        now = time.perf_counter()
+        delta = int((now - self.last) * 1000000)
+        self.last = now
+        self.file.write(EVENT.pack(kind, min(delta, 0xffffffff), len(data)))
+        self.file.write(data)
+        self.events += 1
+
+    def write(self, data):
+        result = self.inner.write(data)
+        self._event(WRITE, bytes(data))
+        return result
+
+    def read(self, size, timeout=None):
+        data = self.inner.read(size, timeout)
+        self._event(READ, bytes(data))
+        return data
+
+    def finish(self):
+        # stop recording, handing back the wrapped transport
+        self.file.close()
+        logger.info('Recorded %d events to %s', self.events, self.path)
+        return self.inner
+
+    def release(self):
+        self.inner.release()
+
+    def close(self):
+        if not self.file.closed:
+            self.finish()
+        self.inner.close()
+
+
+def load(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    if not data.startswith(MAGIC):
+        raise RuntimeError('%s is not a kbprog recording' % path)
+
+    offset = len(MAGIC)
+    length, = HEADER_LENGTH.unpack_from(data, offset)
+    offset += HEADER_LENGTH.size
+    header = json.loads(data[offset:offset + length].decode('utf-8'))
+    offset += length
+
+    events = []
+    view = memoryview(data)
+    while offset < len(data):
+        kind, delta, size = EVENT.unpack_from(data, offset)
+        offset += EVENT.size
+        events.append((kind, delta / 1000000.0,
+                       bytes(view[offset:offset + size])))
+        offset += size
+
+    return header, events
+
+
+class ReplayTransport(transport.Transport):
+    # plays a recording back as a device.  Writes have to match the
+    # recording byte for byte, since anything else means the host side
+    # asked for something the board never answered.  With realtime,
+    # reads wait out the device's recorded delay, less whatever time
+    # the host has spent since; otherwise replies come back at once.
+    def __init__(self, path, realtime=False):
+        self.path = path
+        self.serial = os.path.basename(path)
+        self.realtime = realtime
+        self.header, self.events = load(path)
+        self.resend_on_retry = self.header.get('resend_on_retry', False)
+        self.default_timeout = self.header.get('default_timeout',
+                                               self.default_timeout)
+        self.report_size = self.header.get('report_size', self.report_size)
+        self.position = 0
+        self.last = time.perf_counter()
+
+    def _next(self, kind):
+        if self.position >= len(self.events):
+            raise RuntimeError('Replay of %s ran out after %d events' % (
+                self.path, self.position))
+
+        event_kind, delta, data = self.events[self.position]
+        if event_kind != kind:
+            raise RuntimeError('Replay of %s diverged at event %d: '
+                               'expected a %s' % (
+                                   self.path, self.position,
+                                   'write' if event_kind == WRITE else 'read'))
+        self.position += 1
+
+        if self.realtime:
+            remaining = delta - (time.perf_counter() - self.last)
+            if remaining > 0:
+                time.sleep(remaining)
+        self.last = time.perf_counter()
+
+        return data
+
+    def write(self, data):
+        recorded = self._next(WRITE)
+        if bytes(data) != recorded:
+            raise RuntimeError('Replay of %s diverged at event %d: '
+                               'wrote %s, recorded %s' % (
+                                   self.path, self.position - 1,
+                                   bytes(data).hex(), recorded.hex()))
+        return len(recorded)
+
+    def read(self, size, timeout=None):
+        return self._next(READ)[:size]
@@ -0,0 +1,54 @@
+class RttEstimator(object):
+    # smoothed round trip time and its variance, TCP style (RFC 6298),
+    # for one kind of command.  timeout() is what a read should wait:
+    # srtt + 4 * rttvar, clamped, doubled after each timeout until a
+    # clean sample comes in.  Until the first sample it's the
+    # transport's fixed default.
+    ALPHA = 0.125
+    BETA = 0.25
+    K = 4
+
+    # ms; below this, scheduling jitter alone causes timeouts
+    MIN_TIMEOUT = 50
+
+    def __init__(self, initial, maximum=None):
+        self.initial = initial
+        self.maximum = maximum or initial * 2
+        self.srtt = None
+        self.rttvar = None
+        self.backoffs = 0
+        self.samples = 0
+        self.timeouts = 0
+
+    def sample(self, seconds):
+        # only for replies to a request sent exactly once (Karn), since
+        # otherwise there's no telling which copy was answered
+        ms = seconds * 1000.0
+        if self.srtt is None:
+            self.srtt = ms
+            self.rttvar = ms / 2.0
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + \
+                self.BETA * abs(self.srtt - ms)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * ms
+        self.backoffs = 0
+        self.samples += 1
+
+    def backoff(self):
+        self.backoffs += 1
+        self.timeouts += 1
+
+    def timeout(self):
+        if self.srtt is None:
+            timeout = self.initial
+        else:
+            timeout = self.srtt + self.K * self.rttvar
+        timeout = max(timeout, self.MIN_TIMEOUT) * (2 ** self.backoffs)
+        return int(min(timeout, self.maximum))
+
+    def report(self):
+        return {'samples': self.samples,
+                'timeouts': self.timeouts,
+                'srtt_ms': self.srtt,
+                'rttvar_ms': self.rttvar,
+                'timeout_ms': self.timeout()}
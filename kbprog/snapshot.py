@@ -0,0 +1,166 @@
+import mmap
+import struct
+import zlib
+
+from kbprog.keymap import Keymap
+
+SUFFIX = '.kbsnap'
+MAGIC = b'KBSNAP'
+VERSION = 1
+
+# magic, version, tag length, layout length, rows, cols, layers,
+# protocol, keymap length, macro length, crc32 of everything after
+# the header.  Then the tag and layout names, the keymap exactly as
+# DYNAMIC_KEYMAP_GET_BUFFER returns it (big endian keycodes) and the
+# macro buffer, NUL terminated macros back to back.
+HEADER = struct.Struct('>6sBBBHHBHIII')
+
+
+def is_snapshot(path):
+    if path.endswith(SUFFIX):
+        return True
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+def encode_macros(macros):
+    return b''.join(macro.encode('latin1') + b'\0' for macro in macros)
+
+
+def decode_macros(buffer, count=None):
+    parts = bytes(buffer).split(b'\0')
+    if parts and parts[-1] == b'':
+        parts.pop()
+    if count is not None:
+        parts = parts[:count]
+    return [part.decode('latin1') for part in parts]
+
+
+class Snapshot(object):
+    def __init__(self, tag, layout, rows, cols, layers, protocol,
+                 keymap, macros=None):
+        self.tag = tag
+        self.layout = layout
+        self.rows = rows
+        self.cols = cols
+        self.layers = layers
+        self.protocol = protocol or 0
+        # bytes-like, big endian; memoryviews into the file when loaded
+        self.keymap_buffer = keymap
+        self.macro_buffer = macros
+        self.mmap = None
+
+    @classmethod
+    def from_keymap(cls, tag, layout, protocol, keymap, macros=None):
+        macro_buffer = None
+        if macros is not None:
+            macro_buffer = encode_macros(macros)
+        return cls(tag, layout, keymap.rows, keymap.cols, keymap.layers,
+                   protocol, keymap.tobytes(), macro_buffer)
+
+    def keymap(self):
+        return Keymap.from_bytes(self.keymap_buffer, self.layers,
+                                 self.rows, self.cols)
+
+    def macros(self, count=None):
+        if self.macro_buffer is None:
+            return None
+        return decode_macros(self.macro_buffer, count)
+
+    def _body(self):
+        return [self.tag.encode('utf-8'), self.layout.encode('utf-8'),
+                self.keymap_buffer, self.macro_buffer or b'']
+
+    def write(self, path):
+        body = self._body()
+        crc = 0
+        for part in body:
+            crc = zlib.crc32(part, crc)
+
+        header = HEADER.pack(MAGIC, VERSION, len(body[0]), len(body[1]),
+                             self.rows, self.cols, self.layers,
+                             self.protocol, len(body[2]),
+                             len(body[3]) if self.macro_buffer is not None
+                             else 0xffffffff,
+                             crc)
+
+        with open(path, 'wb') as f:
+            f.write(header)
+            for part in body:
+                f.write(part)
+
+    def close(self):
+        # the buffers are views into the mapping, so they go first
+        if self.mmap is not None:
+            self.keymap_buffer.release()
+            if self.macro_buffer is not None:
+                self.macro_buffer.release()
+            self.mmap.close()
+            self.mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def load(path, check=True):
+    # maps the file rather than reading it; the snapshot's buffers are
+    # views into the mapping until close()
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    view = memoryview(mapped)
+    try:
+        if len(view) < HEADER.size:
+            raise RuntimeError('%s is too short for a snapshot' % path)
+
+        (magic, version, tag_length, layout_length, rows, cols, layers,
+         protocol, keymap_length, macro_length, crc) = \
+            HEADER.unpack_from(view, 0)
+
+        if magic != MAGIC:
+            raise RuntimeError('%s is not a kbprog snapshot' % path)
+        if version != VERSION:
+            raise RuntimeError('%s is snapshot version %d, expected %d' % (
+                path, version, VERSION))
+
+        has_macros = macro_length != 0xffffffff
+        if not has_macros:
+            macro_length = 0
+
+        offset = HEADER.size
+        end = offset + tag_length + layout_length + keymap_length + \
+            macro_length
+        if end != len(view):
+            raise RuntimeError('%s is %d bytes, header says %d' % (
+                path, len(view), end))
+        if keymap_length != layers * rows * cols * 2:
+            raise RuntimeError('%s keymap is %d bytes, expected %d' % (
+                path, keymap_length, layers * rows * cols * 2))
+
+        if check and zlib.crc32(view[offset:end]) != crc:
+            raise RuntimeError('%s fails its checksum' % path)
+
+        tag = bytes(view[offset:offset + tag_length]).decode('utf-8')
+        offset += tag_length
+        layout = bytes(view[offset:offset + layout_length]).decode('utf-8')
+        offset += layout_length
+        keymap = view[offset:offset + keymap_length]
+        offset += keymap_length
+        macros = view[offset:offset + macro_length] if has_macros else None
+    except Exception:
+        view.release()
+        mapped.close()
+        raise
+
+    view.release()
+
+    snapshot = Snapshot(tag, layout, rows, cols, layers, protocol,
+                        keymap, macros)
+    snapshot.mmap = mapped
+    return snapshot
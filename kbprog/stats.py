@@ -0,0 +1,101 @@
+import threading
+
+
+def percentile(ordered, fraction):
+    # nearest-rank percentile of an already sorted list
+    if not ordered:
+        return 0.0
+    rank = int(round(fraction * (len(ordered) - 1)))
+    return ordered[rank]
+
+
+class _Counter(object):
+    def __init__(self):
+        self.count = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.timeouts = 0
+        self.retries = 0
+        self.stale = 0
+        self.failures = 0
+        self.latencies = []
+
+
+class CommandStats(object):
+    # what each command id cost over a session.  latency is from the
+    # first write of a request to its reply.  Separately, elapsed is
+    # wall time spent sending and wait is the part of it blocked in
+    # transport reads, so elapsed - wait is host side overhead.
+    def __init__(self, names=None):
+        self.names = names or {}
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.elapsed = 0.0
+        self.wait = 0.0
+
+    def _counter(self, command):
+        counter = self.counters.get(command)
+        if counter is None:
+            counter = self.counters[command] = _Counter()
+        return counter
+
+    def record(self, command, bytes_out, bytes_in, latency,
+               timeouts=0, retries=0, stale=0):
+        with self.lock:
+            counter = self._counter(command)
+            counter.count += 1
+            counter.bytes_out += bytes_out
+            counter.bytes_in += bytes_in
+            counter.timeouts += timeouts
+            counter.retries += retries
+            counter.stale += stale
+            counter.latencies.append(latency)
+            if not bytes_in:
+                counter.failures += 1
+
+    def record_time(self, elapsed, wait):
+        with self.lock:
+            self.elapsed += elapsed
+            self.wait += wait
+
+    def clear(self):
+        with self.lock:
+            self.counters = {}
+            self.elapsed = 0.0
+            self.wait = 0.0
+
+    def name(self, command):
+        return self.names.get(command, '0x%02x' % command)
+
+    def report(self):
+        report = {}
+        with self.lock:
+            for command, counter in sorted(self.counters.items()):
+                ordered = sorted(counter.latencies)
+                report[self.name(command)] = {
+                    'count': counter.count,
+                    'bytes_out': counter.bytes_out,
+                    'bytes_in': counter.bytes_in,
+                    'timeouts': counter.timeouts,
+                    'retries': counter.retries,
+                    'stale': counter.stale,
+                    'failures': counter.failures,
+                    'seconds': sum(ordered),
+                    'p50_ms': percentile(ordered, 0.50) * 1000.0,
+                    'p95_ms': percentile(ordered, 0.95) * 1000.0,
+                    'p99_ms': percentile(ordered, 0.99) * 1000.0,
+                    'max_ms': ordered[-1] * 1000.0,
+                }
+        return report
+
+    def totals(self):
+        with self.lock:
+            counters = list(self.counters.values())
+            return {'commands': sum(c.count for c in counters),
+                    'bytes_out': sum(c.bytes_out for c in counters),
+                    'bytes_in': sum(c.bytes_in for c in counters),
+                    'timeouts': sum(c.timeouts for c in counters),
+                    'retries': sum(c.retries for c in counters),
+                    'seconds': self.elapsed,
+                    'wait_seconds': self.wait,
+                    'host_seconds': max(self.elapsed - self.wait, 0.0)}
@@ -0,0 +1,183 @@
+import errno
+import os
+
+import usb.core
+import usb.util
+
+
+# raw hid reports are 32 bytes unless the board says otherwise
+DEFAULT_REPORT_SIZE = 32
+
+
+def report_size_from_descriptor(descriptor):
+    # length in bytes of the largest output report in a hid report
+    # descriptor, or None if there isn't one.  Only short items are
+    # understood, which is all raw hid descriptors use.
+    descriptor = bytes(descriptor)
+    report_bits = 0
+    report_count = 0
+    report_id = 0
+    stack = []
+    outputs = {}
+    pos = 0
+
+    while pos < len(descriptor):
+        prefix = descriptor[pos]
+        if prefix == 0xfe:
+            # long item: data size, then tag, then the data
+            if pos + 1 >= len(descriptor):
+                break
+            pos += 3 + descriptor[pos + 1]
+            continue
+
+        size = (0, 1, 2, 4)[prefix & 0x03]
+        value = int.from_bytes(descriptor[pos + 1:pos + 1 + size], 'little')
+        item = prefix & 0xfc
+        pos += 1 + size
+
+        if item == 0x74:  # report size
+            report_bits = value
+        elif item == 0x94:  # report count
+            report_count = value
+        elif item == 0x84:  # report id
+            report_id = value
+        elif item == 0xa4:  # push
+            stack.append((report_bits, report_count, report_id))
+        elif item == 0xb4 and stack:  # pop
+            report_bits, report_count, report_id = stack.pop()
+        elif item == 0x90:  # output
+            outputs[report_id] = outputs.get(report_id, 0) + \
+                report_bits * report_count
+
+    if not outputs:
+        return None
+    return max(outputs.values()) // 8
+
+
+def hidraw_report_descriptor(path):
+    # the kernel's copy, for hidapi builds that can't fetch it
+    if isinstance(path, bytes):
+        path = path.decode('latin1')
+    name = os.path.basename(path)
+    if not name.startswith('hidraw'):
+        return None
+
+    sysfs = '/sys/class/hidraw/%s/device/report_descriptor' % name
+    try:
+        with open(sysfs, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+class Transport(object):
+    # hid devices want the command re-sent when a read times out,
+    # pyusb endpoints just get read again
+    resend_on_retry = False
+    default_timeout = 1000
+    report_size = DEFAULT_REPORT_SIZE
+
+    def write(self, data):
+        raise NotImplementedError
+
+    def read(self, size, timeout=None):
+        raise NotImplementedError
+
+    def release(self):
+        # let go of anything exclusive between daemon requests
+        pass
+
+    def close(self):
+        pass
+
+
+class OfflineTransport(Transport):
+    # stands in for a board that was deliberately left closed
+    def __init__(self, report_size=DEFAULT_REPORT_SIZE):
+        self.report_size = report_size
+
+    def write(self, data):
+        raise RuntimeError('Board was not opened')
+
+    def read(self, size, timeout=None):
+        raise RuntimeError('Board was not opened')
+
+
+class HidTransport(Transport):
+    resend_on_retry = True
+    default_timeout = 300
+
+    def __init__(self, device, path=None):
+        self.device = device
+        self.report_size = self._report_size(path)
+
+    def _report_size(self, path):
+        descriptor = None
+        get_descriptor = getattr(self.device, 'get_report_descriptor', None)
+        if get_descriptor is not None:
+            try:
+                descriptor = get_descriptor()
+            except Exception:
+                descriptor = None
+
+        if descriptor is None and path is not None:
+            descriptor = hidraw_report_descriptor(path)
+
+        size = None
+        if descriptor:
+            size = report_size_from_descriptor(descriptor)
+        # anything smaller isn't a raw hid interface, and won't answer
+        # the protocol probe anyway
+        if size is None or size < DEFAULT_REPORT_SIZE:
+            return DEFAULT_REPORT_SIZE
+        return size
+
+    def write(self, data):
+        return self.device.write(bytes(data))
+
+    def read(self, size, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        return self.device.read(size, timeout)
+
+    def close(self):
+        self.device.close()
+
+
+class UsbTransport(Transport):
+    def __init__(self, device, in_ep, out_ep,
+                 report_size=DEFAULT_REPORT_SIZE, interface=None):
+        self.device = device
+        self.in_ep = in_ep
+        self.out_ep = out_ep
+        self.report_size = report_size
+        self.interface = interface
+
+    def write(self, data):
+        return self.device.write(self.out_ep, data,
+                                 timeout=self.default_timeout)
+
+    def read(self, size, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        try:
+            return self.device.read(self.in_ep, size, timeout=timeout)
+        except usb.core.USBError as e:
+            # an empty read, like hid's, so the caller can retry; older
+            # pyusb has no USBTimeoutError, just the errno
+            timeout_error = getattr(usb.core, 'USBTimeoutError', ())
+            if not isinstance(e, timeout_error) and \
+                    e.errno != errno.ETIMEDOUT:
+                raise
+            return b''
+
+    def release(self):
+        # a claimed interface is exclusive, so anything else (edit, a
+        # --no-daemon run) gets EBUSY until it's given back.  pyusb
+        # claims it again by itself on the next transfer.
+        if self.interface is not None:
+            usb.util.release_interface(self.device, self.interface)
+
+    def close(self):
+        self.release()
+        usb.util.dispose_resources(self.device)